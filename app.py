@@ -1,13 +1,23 @@
+import time
+# কোল্ড স্টার্ট পরিমাপ: ইমপোর্ট শুরুর সময় (সবার আগে রাখা হয়েছে)
+STARTUP_BEGAN = time.perf_counter()
 import os
 import requests
 import logging
 import re
-import time
+import gzip
+import zlib
+import json
+import heapq
+import hashlib
 import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import click
 from flask import Flask, request, jsonify, render_template
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from groq import Groq
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -23,6 +33,8 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
 # PAGE_ACCESS_TOKEN এখন ডাইনামিকালি ডাটাবেস থেকে আসবে, তবে সিডিংয়ের জন্য এনভায়রনমেন্ট থেকে নেওয়া হতে পারে
 FACEBOOK_API_VERSION = os.getenv("FACEBOOK_API_VERSION", "v19.0")
+# Graph API-র বেস URL (লোকাল মক সার্ভারে বেঞ্চমার্ক/টেস্টের জন্য বদলানো যায়)
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com")
 FACEBOOK_APP_ID = os.getenv("FACEBOOK_APP_ID")
  # ড্যাশবোর্ডের জন্য অ্যাপ আইডি
 
@@ -30,85 +42,170 @@ FACEBOOK_APP_ID = os.getenv("FACEBOOK_APP_ID")
 user_last_message_time = {}
 THROTTLE_SECONDS = 10
 
-client = Groq(api_key=GROQ_API_KEY)
+# Graph API কলের টাইমআউট (সেকেন্ড), যাতে ফেসবুক সাড়া না দিলে প্রসেস আটকে না থাকে
+GRAPH_API_TIMEOUT = float(os.getenv("GRAPH_API_TIMEOUT", 10))
+
+# --- Groq Client (Lazy) ---
+# প্রথম LLM কলের সময় তৈরি হয়; এতে ওয়ার্কার বুট এবং টেস্ট ইমপোর্ট দ্রুত হয়
+groq_client = None
+groq_client_lock = threading.Lock()
+
+def get_groq_client():
+    """Groq ক্লায়েন্ট প্রথমবার দরকার হলে তৈরি করে এবং পরে একই ক্লায়েন্ট ফেরত দেয়"""
+    global groq_client
+    if groq_client is None:
+        with groq_client_lock:
+            if groq_client is None:
+                # groq SDK ইমপোর্ট ভারী, তাই এখানেই ইমপোর্ট করা হয়
+                from groq import Groq
+                groq_client = Groq(api_key=GROQ_API_KEY)
+    return groq_client
 
 # --- Database Setup (PostgreSQL) ---
-def get_db_connection():
-    """PostgreSQL ডাটাবেস কানেকশন তৈরি করে"""
-    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-    return conn
-
-def init_db():
-    """ডাটাবেস এবং টেবিল তৈরি করে"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # PostgreSQL সিনট্যাক্স ব্যবহার করা হয়েছে (SERIAL, TIMESTAMP)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id SERIAL PRIMARY KEY,
-            page_id TEXT,
-            sender_id TEXT NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS summaries (
-            page_id TEXT,
-            sender_id TEXT PRIMARY KEY,
-            summary TEXT NOT NULL DEFAULT '',
-            isp_user_id TEXT
-        )
-    ''')
-    # SaaS-এর জন্য কোম্পানি টেবিল
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS companies (
-            id SERIAL PRIMARY KEY,
-            page_id VARCHAR(255) UNIQUE NOT NULL,
-            access_token TEXT NOT NULL,
-            business_info TEXT,
-            bot_name VARCHAR(255)
-        )
-    ''')
+# প্রতি রিকোয়েস্টে নতুন কানেকশন না খুলে প্রসেসপ্রতি একটি কানেকশন পুল ব্যবহার করা হয়
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+db_pool = None
+db_pool_lock = threading.Lock()
 
-    # স্কিমা মাইগ্রেশন: কলাম যোগ করা (PostgreSQL স্টাইল)
+def get_db_connection():
+    """পুল থেকে PostgreSQL কানেকশন নেয় (পুল পূর্ণ থাকলে আলাদা কানেকশন তৈরি করে)"""
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                db_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, os.getenv("DATABASE_URL"))
     try:
-        cursor.execute('ALTER TABLE summaries ADD COLUMN isp_user_id TEXT')
-    except psycopg2.errors.DuplicateColumn:
-        conn.rollback() # এরর হলে রোলব্যাক করতে হবে
-    else:
-        conn.commit()
+        return db_pool.getconn()
+    except PoolError:
+        logging.warning(f"Database pool exhausted ({DB_POOL_MAX} connections in use); opening an unpooled connection")
+        return psycopg2.connect(os.getenv("DATABASE_URL"))
 
+def release_db_connection(conn):
+    """কানেকশন পুলে ফেরত দেয় (অসমাপ্ত ট্রানজ্যাকশন পুল নিজেই রোলব্যাক করে)"""
     try:
-        cursor.execute('ALTER TABLE messages ADD COLUMN page_id TEXT')
-    except psycopg2.errors.DuplicateColumn:
-        conn.rollback()
-    else:
-        conn.commit()
+        # ডাটাবেস রিস্টার্টে ভেঙে যাওয়া কানেকশন পুলে রাখা হয় না
+        db_pool.putconn(conn, close=bool(conn.closed))
+    except PoolError:
+        # পুলের বাইরের কানেকশন
+        conn.close()
 
+@contextmanager
+def db_connection():
+    """এক্সেপশন হলেও কানেকশন পুলে ফেরত যায়"""
+    conn = get_db_connection()
     try:
-        cursor.execute('ALTER TABLE summaries ADD COLUMN page_id TEXT')
-    except psycopg2.errors.DuplicateColumn:
-        conn.rollback()
-    else:
-        conn.commit()
+        yield conn
+    finally:
+        release_db_connection(conn)
 
-    try:
-        cursor.execute('ALTER TABLE summaries ADD COLUMN user_name TEXT')
-    except psycopg2.errors.DuplicateColumn:
-        conn.rollback()
+def init_db():
+    """ডাটাবেস এবং টেবিল তৈরি করে এবং স্কিমা মাইগ্রেট করে (একটি ট্রানজ্যাকশনে; ইনডেক্স পরে আলাদাভাবে)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        # PostgreSQL সিনট্যাক্স ব্যবহার করা হয়েছে (SERIAL, TIMESTAMP)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id SERIAL PRIMARY KEY,
+                page_id TEXT,
+                sender_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS summaries (
+                page_id TEXT,
+                sender_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                isp_user_id TEXT
+            )
+        ''')
+        # SaaS-এর জন্য কোম্পানি টেবিল
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS companies (
+                id SERIAL PRIMARY KEY,
+                page_id VARCHAR(255) UNIQUE NOT NULL,
+                access_token TEXT NOT NULL,
+                business_info TEXT,
+                bot_name VARCHAR(255)
+            )
+        ''')
+
+        # স্কিমা মাইগ্রেশন: কলাম যোগ করা (ADD COLUMN IF NOT EXISTS, PostgreSQL 9.6+)
+        cursor.execute('''
+            ALTER TABLE messages ADD COLUMN IF NOT EXISTS page_id TEXT
+        ''')
+        cursor.execute('''
+            ALTER TABLE summaries
+                ADD COLUMN IF NOT EXISTS isp_user_id TEXT,
+                ADD COLUMN IF NOT EXISTS page_id TEXT,
+                ADD COLUMN IF NOT EXISTS user_name TEXT
+        ''')
+        # পেজভিত্তিক বাজেট (NULL থাকলে এনভায়রনমেন্টের ডিফল্ট) এবং কন্ডিশনাল GET (ETag)-এর জন্য updated_at
+        cursor.execute('''
+            ALTER TABLE companies
+                ADD COLUMN IF NOT EXISTS page_name TEXT,
+                ADD COLUMN IF NOT EXISTS weight INTEGER,
+                ADD COLUMN IF NOT EXISTS rpm_limit INTEGER,
+                ADD COLUMN IF NOT EXISTS daily_token_budget INTEGER,
+                ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS kb_version INTEGER
+        ''')
+        # business_info থেকে কম্পাইল করা নলেজ বেসের ভার্সনভিত্তিক স্ন্যাপশট (zlib-কম্প্রেসড JSON)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS kb_snapshots (
+                page_id TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                snapshot BYTEA NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (page_id, version)
+            )
+        ''')
+
+        # প্রতিদিনের পেজভিত্তিক ব্যবহার (ড্যাশবোর্ডের কাউন্টারের জন্য)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS page_usage (
+                page_id TEXT NOT NULL,
+                day DATE NOT NULL DEFAULT CURRENT_DATE,
+                requests INTEGER NOT NULL DEFAULT 0,
+                tokens INTEGER NOT NULL DEFAULT 0,
+                degraded INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (page_id, day)
+            )
+        ''')
 
-    try:
-        cursor.execute('ALTER TABLE companies ADD COLUMN page_name TEXT')
-    except psycopg2.errors.DuplicateColumn:
-        conn.rollback()
-    else:
         conn.commit()
+    create_message_indexes()
+
+# অ্যাডমিন API-র keyset পেজিনেশন এবং হিস্ট্রি কোয়েরির জন্য ইনডেক্স
+MESSAGE_INDEXES = {
+    "idx_messages_page_sender_id": "messages (page_id, sender_id, id)",
+    "idx_messages_sender_timestamp": "messages (sender_id, timestamp)",
+}
 
-    conn.commit()
-    conn.close()
+def create_message_indexes():
+    """messages-এর ইনডেক্স CONCURRENTLY তৈরি করে, যাতে রিলিজের সময় ইনসার্ট আটকে না যায়।
+
+    CONCURRENTLY ট্রানজ্যাকশনের ভেতরে চলে না, তাই মাইগ্রেশন কমিটের পরে autocommit কানেকশনে চলে।
+    আগের বিল্ড মাঝপথে ব্যর্থ হলে INVALID ইনডেক্স থেকে যায় (IF NOT EXISTS সেটি এড়িয়ে যেত), তাই সেটি আগে ড্রপ হয়।
+    """
+    with db_connection() as conn:
+        conn.autocommit = True
+        try:
+            cursor = conn.cursor()
+            for name, definition in MESSAGE_INDEXES.items():
+                cursor.execute('''
+                    SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                    WHERE c.relname = %s AND NOT i.indisvalid
+                ''', (name,))
+                if cursor.fetchone():
+                    cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+                cursor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+        finally:
+            conn.autocommit = False
 
 def seed_db():
     """এনভায়রনমেন্ট ভেরিয়েবল থেকে ডিফল্ট কোম্পানি সেটআপ করে (মাইগ্রেশনের সুবিধার্থে)"""
@@ -116,7 +213,7 @@ def seed_db():
     if default_token:
         try:
             # ফেসবুক গ্রাফ এপিআই থেকে পেজ আইডি বের করা
-            resp = requests.get(f"https://graph.facebook.com/me?access_token={default_token}")
+            resp = requests.get(f"{GRAPH_API_URL}/me?access_token={default_token}", timeout=GRAPH_API_TIMEOUT)
             if resp.status_code == 200:
                 page_data = resp.json()
                 page_id = page_data.get("id")
@@ -130,134 +227,398 @@ def seed_db():
                 except FileNotFoundError:
                     pass
 
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                # যদি কোম্পানি না থাকে তবেই ইনসার্ট করবে
-                cursor.execute('''
-                    INSERT INTO companies (page_id, access_token, business_info, bot_name, page_name)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON CONFLICT (page_id) DO NOTHING
-                ''', (page_id, default_token, business_info, "স্পিড নেট", page_name))
-                conn.commit()
-                conn.close()
+                with db_connection() as conn:
+                    cursor = conn.cursor()
+                    # যদি কোম্পানি না থাকে তবেই ইনসার্ট করবে
+                    cursor.execute('''
+                        INSERT INTO companies (page_id, access_token, business_info, bot_name, page_name)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (page_id) DO NOTHING
+                    ''', (page_id, default_token, business_info, "স্পিড নেট", page_name))
+                    conn.commit()
                 logging.info(f"Default company seeded: {page_data.get('name')} ({page_id})")
         except Exception as e:
             logging.error(f"Seeding failed: {e}")
 
+# কুয়েরিগুলো কনস্ট্যান্ট হিসেবে রাখা হয়েছে যাতে sync (psycopg2) এবং async (asgi.py, psycopg 3) দুই পথেই একই SQL চলে
+COMPANY_CONFIG_SQL = 'SELECT access_token, business_info, bot_name, weight, rpm_limit, daily_token_budget, kb_version FROM companies WHERE page_id = %s'
+INSERT_MESSAGE_SQL = 'INSERT INTO messages (page_id, sender_id, role, content) VALUES (%s, %s, %s, %s)'
+USER_PROFILE_SQL = 'SELECT summary, isp_user_id, user_name FROM summaries WHERE sender_id = %s'
+UPSERT_USER_NAME_SQL = '''
+    INSERT INTO summaries (sender_id, page_id, user_name) VALUES (%s, %s, %s)
+    ON CONFLICT (sender_id) DO UPDATE SET user_name = EXCLUDED.user_name, page_id = EXCLUDED.page_id
+'''
+# PostgreSQL Upsert (ON CONFLICT)
+UPSERT_SUMMARY_SQL = '''
+    INSERT INTO summaries (sender_id, page_id, summary) VALUES (%s, %s, %s)
+    ON CONFLICT (sender_id) DO UPDATE SET summary = EXCLUDED.summary, page_id = EXCLUDED.page_id
+'''
+UPSERT_ISP_USER_ID_SQL = '''
+    INSERT INTO summaries (sender_id, page_id, isp_user_id) VALUES (%s, %s, %s)
+    ON CONFLICT (sender_id) DO UPDATE SET isp_user_id = EXCLUDED.isp_user_id, page_id = EXCLUDED.page_id
+'''
+COUNT_MESSAGES_SQL = 'SELECT COUNT(*) as count FROM messages WHERE sender_id = %s AND page_id = %s'
+OLDEST_MESSAGES_SQL = 'SELECT id, role, content FROM messages WHERE sender_id = %s AND page_id = %s ORDER BY timestamp ASC LIMIT 5'
+DELETE_MESSAGES_SQL = 'DELETE FROM messages WHERE id = ANY(%s)'
+PRUNE_THRESHOLD = 10
+
 def get_company_config(page_id):
-    """ডাটাবেস থেকে নির্দিষ্ট কোম্পানির কনফিগারেশন নিয়ে আসে"""
-    # সরাসরি ডাটাবেস থেকে কনফিগারেশন আনা (Redis ক্যাশ ছাড়া)
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute('SELECT access_token, business_info, bot_name FROM companies WHERE page_id = %s', (page_id,))
-    row = cursor.fetchone()
-    conn.close()
+    """ডাটাবেস থেকে নির্দিষ্ট কোম্পানির কনফিগারেশন নিয়ে আসে"""
+    # সরাসরি ডাটাবেস থেকে কনফিগারেশন আনা (Redis ক্যাশ ছাড়া)
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(COMPANY_CONFIG_SQL, (page_id,))
+        row = cursor.fetchone()
     
     return row
 
 def add_message_to_history(page_id, sender_id, role, content):
     """ডাটাবেসে মেসেজ সংরক্ষণ করে"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO messages (page_id, sender_id, role, content) VALUES (%s, %s, %s, %s)', (page_id, sender_id, role, content))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(INSERT_MESSAGE_SQL, (page_id, sender_id, role, content))
+        conn.commit()
 
 def get_conversation_history(page_id, sender_id, limit=10):
     """নির্দিষ্ট ইউজারের পুরনো মেসেজগুলো ডাটাবেস থেকে নিয়ে আসে"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    # page_id ফিল্টার যোগ করা হয়েছে
-    cursor.execute('SELECT role, content FROM messages WHERE sender_id = %s AND (page_id = %s OR page_id IS NULL) ORDER BY timestamp DESC LIMIT %s', (sender_id, page_id, limit))
-    messages = cursor.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # page_id ফিল্টার যোগ করা হয়েছে
+        cursor.execute('SELECT role, content FROM messages WHERE sender_id = %s AND (page_id = %s OR page_id IS NULL) ORDER BY timestamp DESC LIMIT %s', (sender_id, page_id, limit))
+        messages = cursor.fetchall()
     return [{"role": msg["role"], "content": msg["content"]} for msg in reversed(messages)]
 
 def get_user_profile(page_id, sender_id):
     """ডাটাবেস থেকে ইউজারের সামারি এবং ISP ইউজার আইডি নিয়ে আসে"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute('SELECT summary, isp_user_id, user_name FROM summaries WHERE sender_id = %s', (sender_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(USER_PROFILE_SQL, (sender_id,))
+        row = cursor.fetchone()
+    return user_profile_from_row(row)
+
+def user_profile_from_row(row):
+    """summaries-এর রো থেকে প্রোফাইল ডিকশনারি তৈরি করে (রো না থাকলে খালি প্রোফাইল)"""
     if row:
         return {"summary": row["summary"], "isp_user_id": row["isp_user_id"], "user_name": row.get("user_name")}
     return {"summary": "", "isp_user_id": None, "user_name": None}
 
 def update_user_name(page_id, sender_id, user_name):
     """ডাটাবেসে ইউজারের নাম আপডেট করে"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO summaries (sender_id, page_id, user_name) VALUES (%s, %s, %s)
-        ON CONFLICT (sender_id) DO UPDATE SET user_name = EXCLUDED.user_name, page_id = EXCLUDED.page_id
-    ''', (sender_id, page_id, user_name))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UPSERT_USER_NAME_SQL, (sender_id, page_id, user_name))
+        conn.commit()
 
 def save_summary(page_id, sender_id, summary):
     """ডাটাবেসে শুধুমাত্র সামারি আপডেট করে"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # PostgreSQL Upsert (ON CONFLICT)
-    cursor.execute('''
-        INSERT INTO summaries (sender_id, page_id, summary) VALUES (%s, %s, %s)
-        ON CONFLICT (sender_id) DO UPDATE SET summary = EXCLUDED.summary, page_id = EXCLUDED.page_id
-    ''', (sender_id, page_id, summary))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UPSERT_SUMMARY_SQL, (sender_id, page_id, summary))
+        conn.commit()
 
 def save_isp_user_id(page_id, sender_id, isp_user_id):
     """ডাটাবেসে শুধুমাত্র ISP ইউজার আইডি আপডেট করে"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO summaries (sender_id, page_id, isp_user_id) VALUES (%s, %s, %s)
-        ON CONFLICT (sender_id) DO UPDATE SET isp_user_id = EXCLUDED.isp_user_id, page_id = EXCLUDED.page_id
-    ''', (sender_id, page_id, isp_user_id))
-    conn.commit()
-    conn.close()
-
-def generate_summary(current_summary, new_lines):
-    """LLM ব্যবহার করে সামারি আপডেট করে"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UPSERT_ISP_USER_ID_SQL, (sender_id, page_id, isp_user_id))
+        conn.commit()
+
+def build_summary_request(current_summary, new_lines):
+    """সামারি আপডেটের জন্য Groq রিকোয়েস্টের প্যারামিটার তৈরি করে"""
     prompt = (
         f"Update the conversation summary with the new lines. Keep it concise and relevant to customer support.\n"
         f"Current Summary: {current_summary}\n"
         f"New Lines:\n{new_lines}\n"
         f"Output only the updated summary."
     )
+    return {
+        "messages": [{"role": "system", "content": "You are a helpful assistant that summarizes conversations."}, {"role": "user", "content": prompt}],
+        "model": "llama-3.1-8b-instant",
+        "max_tokens": 200,
+    }
+
+def generate_summary(current_summary, new_lines, page_id=None, company_config=None):
+    """LLM ব্যবহার করে সামারি আপডেট করে; থ্রোটলড বা ব্যর্থ হলে None (তখন পুরনো মেসেজ ডিলিট করা যাবে না)"""
     try:
-        completion = client.chat.completions.create(
-            messages=[{"role": "system", "content": "You are a helpful assistant that summarizes conversations."}, {"role": "user", "content": prompt}],
-            model="llama-3.1-8b-instant",
-            max_tokens=200
-        )
+        # ব্যাকগ্রাউন্ড সামারি বাদ পড়লে ইউজার কিছু টের পান না, তাই সেটি degraded হিসেবে গণনা হয় না
+        completion = groq_completion(page_id, company_config, count_degraded=False,
+                                     **build_summary_request(current_summary, new_lines))
         return completion.choices[0].message.content
+    except TenantBudgetExceeded:
+        logging.warning(f"Skipping summarization for page {page_id}: budget exhausted")
+        return None
     except Exception as e:
         logging.error(f"Summarization failed: {e}")
-        return current_summary
+        return None
 
-def prune_and_summarize(page_id, sender_id):
+def prune_and_summarize(page_id, sender_id, company_config=None):
     """মেসেজ সংখ্যা বেশি হলে পুরনো মেসেজ সামারি করে ডিলিট করে"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute('SELECT COUNT(*) as count FROM messages WHERE sender_id = %s AND page_id = %s', (sender_id, page_id))
-    count = cursor.fetchone()['count']
-    
-    if count > 10:  # যদি ১০টির বেশি মেসেজ থাকে
-        cursor.execute('SELECT id, role, content FROM messages WHERE sender_id = %s AND page_id = %s ORDER BY timestamp ASC LIMIT 5', (sender_id, page_id))
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(COUNT_MESSAGES_SQL, (sender_id, page_id))
+        count = cursor.fetchone()['count']
+        if count <= PRUNE_THRESHOLD:
+            return
+        cursor.execute(OLDEST_MESSAGES_SQL, (sender_id, page_id))
         old_msgs = cursor.fetchall()
-        if old_msgs:
-            ids_to_delete = [msg['id'] for msg in old_msgs]
-            text_to_summarize = "\n".join([f"{msg['role']}: {msg['content']}" for msg in old_msgs])
-            current_summary = get_user_profile(page_id, sender_id).get("summary", "")
-            new_summary = generate_summary(current_summary, text_to_summarize)
-            save_summary(page_id, sender_id, new_summary)
-            # PostgreSQL এ tuple ব্যবহার করে IN ক্লজ
-            cursor.execute('DELETE FROM messages WHERE id IN %s', (tuple(ids_to_delete),))
+    if not old_msgs:
+        return
+
+    # LLM কলের সময় কানেকশন পুলে ফেরত থাকে
+    ids_to_delete = [msg['id'] for msg in old_msgs]
+    text_to_summarize = "\n".join([f"{msg['role']}: {msg['content']}" for msg in old_msgs])
+    current_summary = get_user_profile(page_id, sender_id).get("summary", "")
+    new_summary = generate_summary(current_summary, text_to_summarize, page_id, company_config)
+    if new_summary is None:
+        return  # মেসেজগুলো থেকে যায়, পরের মেসেজে আবার চেষ্টা হবে
+    save_summary(page_id, sender_id, new_summary)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # PostgreSQL এ লিস্ট ব্যবহার করে ANY ক্লজ
+        cursor.execute(DELETE_MESSAGES_SQL, (ids_to_delete,))
+        conn.commit()
+    logging.info(f"Summarized and pruned {len(ids_to_delete)} messages for {sender_id}")
+
+# --- Per-Tenant Budgets & Fair Scheduling ---
+# সব পেজ একই Groq কোটা শেয়ার করে। একটি ব্যস্ত পেজ যেন বাকিদের "ব্যস্ত" ফলব্যাকে ঠেলে না দেয়,
+# সেজন্য প্রতিটি পেজের রিকোয়েস্ট/টোকেন বাজেট আছে এবং LLM কলগুলো weighted fair queue-তে চলে।
+TENANT_RPM_LIMIT = int(os.getenv("TENANT_RPM_LIMIT", 30))
+TENANT_DAILY_TOKEN_BUDGET = int(os.getenv("TENANT_DAILY_TOKEN_BUDGET", 200000))
+TENANT_MAX_PENDING = int(os.getenv("TENANT_MAX_PENDING", 10))
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", 4))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 30))
+# থ্রোটলড (degraded) কলের সংখ্যা মেমরিতে জমে এবং এই বিরতিতে একসাথে ডাটাবেসে লেখা হয়
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", 10))
+
+def usage_day():
+    """ব্যবহারের হিসাবের দিন; page_usage-এর কুয়েরিতেও এটিই পাঠানো হয় যাতে প্রসেস ও ডাটাবেসের দিন এক থাকে"""
+    return time.strftime("%Y-%m-%d")
+
+class TenantBudgetExceeded(Exception):
+    """পেজের রেট লিমিট, টোকেন বাজেট বা কিউ সীমা পূর্ণ হলে রেইজ হয়"""
+
+class TenantScheduler:
+    """পেজভিত্তিক বাজেট যাচাই করে Groq কলগুলো weighted fair queue অনুযায়ী নির্দিষ্ট সংখ্যক ওয়ার্কারে চালায়।
+
+    প্রতিটি কলের একটি finish tag থাকে: max(virtual_time, পেজের আগের finish) + cost / weight।
+    সবচেয়ে ছোট tag আগে চলে, তাই বেশি কল পাঠানো পেজ নিজের কিউতেই পিছিয়ে যায়, অন্যদের নয়।
+
+    দৈনিক টোকেন বাজেট page_usage টেবিলের মাধ্যমে সব প্রসেসে শেয়ার হয়; রেট লিমিট (rpm) প্রতিটি
+    প্রসেসের নিজস্ব, তাই কার্যকর সীমা rpm_limit × প্রসেস সংখ্যা।
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Condition()
+        self.heap = []
+        self.seq = 0
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        self.pending = {}
+        self.buckets = {}  # page_id -> (available_requests, last_refill_time)
+        self.usage = {}    # page_id -> {"day", "requests", "tokens", "degraded"}
+        self.seeded = {}   # page_id -> ডাটাবেস থেকে যে দিনের ব্যবহার লোড হয়েছে
+        self.unflushed_degraded = {}
+        self.threads = []
+
+    def usage_for(self, page_id):
+        """এই ওয়ার্কারের জানা আজকের ব্যবহার (দিন বদলালে রিসেট হয়)"""
+        today = usage_day()
+        usage = self.usage.get(page_id)
+        if not usage or usage["day"] != today:
+            usage = {"day": today, "requests": 0, "tokens": 0, "degraded": 0}
+            self.usage[page_id] = usage
+        return usage
+
+    def needs_seed(self, page_id):
+        """নতুন পেজ (বা নতুন দিন) হলে আগে ডাটাবেস থেকে আজকের ব্যবহার লোড করতে হবে"""
+        return self.seeded.get(page_id) != usage_day()
+
+    def seed_usage(self, page_id, row):
+        """অন্য প্রসেসগুলোর আগের খরচ লোকাল হিসেবে বসায় (row: page_usage-এর আজকের রো; লোড ব্যর্থ হলে None)"""
+        if row is None:
+            return  # পরের কলে আবার চেষ্টা হবে
+        with self.lock:
+            usage = self.usage_for(page_id)
+            for key in ("requests", "tokens", "degraded"):
+                usage[key] = max(usage[key], row.get(key, 0))
+            self.seeded[page_id] = usage["day"]
+
+    def take_unflushed_degraded(self):
+        """ডাটাবেসে লেখার জন্য জমে থাকা degraded সংখ্যাগুলো নিয়ে কাউন্টার খালি করে"""
+        with self.lock:
+            pending, self.unflushed_degraded = self.unflushed_degraded, {}
+        return pending
+
+    def _take_rate_token(self, page_id, rpm_limit):
+        """Token bucket: প্রতি মিনিটে rpm_limit টি রিকোয়েস্ট, বার্স্টও সর্বোচ্চ rpm_limit"""
+        now = time.time()
+        available, last_refill = self.buckets.get(page_id, (rpm_limit, now))
+        available = min(rpm_limit, available + (now - last_refill) * rpm_limit / 60.0)
+        if available < 1:
+            self.buckets[page_id] = (available, now)
+            return False
+        self.buckets[page_id] = (available - 1, now)
+        return True
+
+    def _admit(self, page_id, weight, rpm_limit, token_budget, cost, count_degraded=True):
+        """বাজেট যাচাই করে কলের finish tag ফেরত দেয়; lock ধরে রেখে কল করতে হবে"""
+        usage = self.usage_for(page_id)
+        if self.pending.get(page_id, 0) >= TENANT_MAX_PENDING:
+            reason = "queue full"
+        elif usage["tokens"] >= token_budget:
+            reason = "daily token budget exhausted"
+        elif not self._take_rate_token(page_id, rpm_limit):
+            reason = "rate limit"
+        else:
+            start = max(self.virtual_time, self.last_finish.get(page_id, 0.0))
+            finish = start + cost / max(weight, 1)
+            self.last_finish[page_id] = finish
+            self.pending[page_id] = self.pending.get(page_id, 0) + 1
+            return start, finish
+        if count_degraded:
+            usage["degraded"] += 1
+            self.unflushed_degraded[page_id] = self.unflushed_degraded.get(page_id, 0) + 1
+        raise TenantBudgetExceeded(f"{page_id}: {reason}")
+
+    def merge_usage(self, page_id, total_tokens, day):
+        """ডাটাবেসের মোট টোকেন (সব ওয়ার্কার মিলিয়ে) লোকাল হিসেবে বসায়; অন্য দিনের মোট হলে উপেক্ষা করে"""
+        with self.lock:
+            usage = self.usage_for(page_id)
+            if usage["day"] == day:
+                usage["tokens"] = max(usage["tokens"], total_tokens)
+
+    def _done(self, page_id, tokens, ran):
+        """কল শেষ হলে (বা বাতিল হয়ে এড়িয়ে গেলে) pending কমায়; শুধু চলা কলই রিকোয়েস্ট হিসেবে গণনা হয়"""
+        with self.lock:
+            self.pending[page_id] -= 1
+            if self.pending[page_id] <= 0:
+                del self.pending[page_id]
+            usage = self.usage_for(page_id)
+            if ran:
+                usage["requests"] += 1
+                usage["tokens"] += tokens
+
+    def submit(self, page_id, call, weight=1, rpm_limit=TENANT_RPM_LIMIT, token_budget=TENANT_DAILY_TOKEN_BUDGET, cost=1,
+               count_degraded=True):
+        """কলটি কিউতে রাখে এবং একটি Future ফেরত দেয়; বাজেট শেষ হলে TenantBudgetExceeded"""
+        if self.needs_seed(page_id):
+            self.seed_usage(page_id, load_page_usage(page_id))
+        with self.lock:
+            if not self.threads:
+                for target in [self._worker] * self.workers + [self._flusher]:
+                    thread = threading.Thread(target=target, daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+            start, finish = self._admit(page_id, weight, rpm_limit, token_budget, cost, count_degraded)
+            future = Future()
+            heapq.heappush(self.heap, (finish, self.seq, start, page_id, call, future))
+            self.seq += 1
+            self.lock.notify()
+        return future
+
+    def run(self, page_id, call, **limits):
+        """submit() করে ফলাফলের জন্য অপেক্ষা করে; সময় শেষ হলে কিউতে থাকা কলটি বাতিল হয়"""
+        future = self.submit(page_id, call, **limits)
+        try:
+            return future.result(timeout=LLM_QUEUE_TIMEOUT)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                while not self.heap:
+                    self.lock.wait()
+                _, _, start, page_id, call, future = heapq.heappop(self.heap)
+                self.virtual_time = max(self.virtual_time, start)
+
+            tokens = 0
+            ran = future.set_running_or_notify_cancel()
+            if ran:
+                try:
+                    result = call()
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    usage = getattr(result, "usage", None)
+                    tokens = getattr(usage, "total_tokens", 0) or 0
+                    future.set_result(result)
+            self._done(page_id, tokens, ran)
+            if ran:
+                record_page_usage(page_id, requests=1, tokens=tokens)
+
+    def flush_degraded(self):
+        """থ্রোটলড কলগুলো রিকোয়েস্ট থ্রেডে ডাটাবেসে লেখা হয় না; জমে থাকা সংখ্যা একসাথে লেখে"""
+        for page_id, degraded in self.take_unflushed_degraded().items():
+            record_page_usage(page_id, degraded=degraded)
+
+    def _flusher(self):
+        while True:
+            time.sleep(USAGE_FLUSH_SECONDS)
+            self.flush_degraded()
+
+llm_scheduler = TenantScheduler(LLM_WORKERS)
+
+RECORD_USAGE_SQL = '''
+    INSERT INTO page_usage (page_id, day, requests, tokens, degraded) VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (page_id, day) DO UPDATE SET requests = page_usage.requests + EXCLUDED.requests,
+        tokens = page_usage.tokens + EXCLUDED.tokens, degraded = page_usage.degraded + EXCLUDED.degraded
+    RETURNING tokens
+'''
+
+PAGE_USAGE_SQL = 'SELECT requests, tokens, degraded FROM page_usage WHERE page_id = %s AND day = %s'
+
+def load_page_usage(page_id):
+    """পেজের আজকের মোট ব্যবহার (সব প্রসেস মিলিয়ে; আজ কিছু না থাকলে {}); ডাটাবেসে সমস্যা হলে None"""
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute(PAGE_USAGE_SQL, (page_id, usage_day()))
+            return cursor.fetchone() or {}
+    except Exception as e:
+        logging.error(f"Failed to load usage for {page_id}: {e}")
+        return None
+
+def record_page_usage(page_id, requests=0, tokens=0, degraded=0):
+    """আজকের ব্যবহার ডাটাবেসে যোগ করে, যাতে সব ওয়ার্কারের মোট টোকেন বাজেটে গণনা হয়"""
+    day = usage_day()
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(RECORD_USAGE_SQL, (page_id, day, requests, tokens, degraded))
+            total_tokens = cursor.fetchone()[0]
             conn.commit()
-            logging.info(f"Summarized and pruned {len(ids_to_delete)} messages for {sender_id}")
-    conn.close()
+    except Exception as e:
+        logging.error(f"Failed to record usage for {page_id}: {e}")
+        return
+    # অন্য ওয়ার্কারের খরচসহ মোট টোকেন লোকাল হিসেবে বসানো
+    llm_scheduler.merge_usage(page_id, total_tokens, day)
+
+def completion_limits(company_config, request_kwargs):
+    """কোম্পানির কনফিগারেশন থেকে শিডিউলারের weight/বাজেট এবং রিকোয়েস্টের আনুমানিক খরচ বের করে"""
+    company_config = company_config or {}
+    prompt_chars = sum(len(m["content"]) for m in request_kwargs.get("messages", []))
+    return {
+        "weight": company_config.get("weight") or 1,
+        "rpm_limit": company_config.get("rpm_limit") or TENANT_RPM_LIMIT,
+        "token_budget": company_config.get("daily_token_budget") or TENANT_DAILY_TOKEN_BUDGET,
+        # আনুমানিক টোকেন খরচ (প্রায় ৪ অক্ষরে ১ টোকেন) + সর্বোচ্চ আউটপুট
+        "cost": prompt_chars // 4 + request_kwargs.get("max_tokens", 0),
+    }
+
+def groq_completion(page_id, company_config=None, count_degraded=True, **kwargs):
+    """সব Groq কল এই ফাংশনের মাধ্যমে যায়, যাতে পেজের বাজেট ও ফেয়ার শিডিউলিং প্রযোজ্য হয়"""
+    if not page_id:
+        # কোনো পেজের সাথে যুক্ত নয় এমন প্রিভিউ: বাজেট বা ব্যবহার হিসাব ছাড়াই সরাসরি কল
+        return get_groq_client().chat.completions.create(**kwargs)
+    return llm_scheduler.run(
+        page_id,
+        lambda: get_groq_client().chat.completions.create(**kwargs),
+        count_degraded=count_degraded,
+        **completion_limits(company_config, kwargs)
+    )
 
 # --- Context Parsing Logic (Now Dynamic) ---
 
@@ -286,13 +647,13 @@ CONTEXT_KEYWORDS = {
     'অফার ও নোটিশ': ['অফার', 'offer', 'notice', 'নোটিশ', 'ডিসকাউন্ট', 'discount'],
 }
 
-def get_dynamic_context(user_question, parsed_context):
-    """Selects relevant sections from the context based on keywords."""
+def get_dynamic_context(user_question, parsed_context, keyword_index=None):
+    """Selects relevant sections from the context based on keywords (keyword_index: compiled [section, keywords] pairs)."""
     relevant_sections = []
     question_lower = user_question.lower()
     found_keys = set()
 
-    for section_key, keywords in CONTEXT_KEYWORDS.items():
+    for section_key, keywords in (keyword_index if keyword_index is not None else CONTEXT_KEYWORDS.items()):
         for keyword in keywords:
             if keyword in question_lower:
                 if section_key in parsed_context and section_key not in found_keys:
@@ -304,10 +665,135 @@ def get_dynamic_context(user_question, parsed_context):
         return "সাধারণ তথ্য এই মুহূর্তে উপলব্ধ নেই। অনুগ্রহ করে আমাদের হটলাইনে (09639333111) যোগাযোগ করুন।"
     return "\n\n---\n\n".join(relevant_sections)
 
+# --- Knowledge Base Compilation & Versioned Snapshots ---
+# /register-এ সেভ করার সময় business_info একবার কম্পাইল হয় (সেকশন পার্স + কীওয়ার্ড ইনডেক্স)।
+# আগের ভার্সনের সাথে সেকশন হ্যাশ মিলিয়ে শুধু পরিবর্তিত অংশ নতুন করে তৈরি হয়, এবং ফলাফল
+# ভার্সনসহ kb_snapshots টেবিলে থাকে। ওয়ার্কাররা প্রতি মেসেজে পার্স না করে স্ন্যাপশট লোড করে।
+KB_FORMAT = 1
+KB_SNAPSHOT_RETENTION = int(os.getenv("KB_SNAPSHOT_RETENTION", 10))
+KB_SNAPSHOT_SQL = 'SELECT snapshot FROM kb_snapshots WHERE page_id = %s AND version = %s'
+
+# কীওয়ার্ড ইনডেক্স CONTEXT_KEYWORDS থেকে তৈরি; কোড বদলালে হ্যাশও বদলায় এবং পুরনো স্ন্যাপশটের ইনডেক্স নতুন করে তৈরি হয়
+CONTEXT_KEYWORDS_HASH = hashlib.sha1(json.dumps(CONTEXT_KEYWORDS, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+# page_id -> (version, compiled knowledge base); পুরো টাপল একবারে বদলানো হয়, তাই রিডাররা কখনো অর্ধেক আপডেট দেখে না
+knowledge_base_cache = {}
+
+def compile_knowledge_base(business_info, previous=None):
+    """business_info কম্পাইল করে; previous স্ন্যাপশটের অপরিবর্তিত সেকশনগুলো পুনরায় ব্যবহার করে"""
+    previous_sections = previous["sections"] if previous and previous.get("format") == KB_FORMAT else {}
+    sections = {}
+    changes = {"added": 0, "changed": 0, "unchanged": 0}
+    for key, text in parse_isp_context(business_info).items():
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        old = previous_sections.get(key)
+        if old and old["hash"] == digest:
+            sections[key] = old
+            changes["unchanged"] += 1
+        else:
+            sections[key] = {"hash": digest, "text": text}
+            changes["changed" if old else "added"] += 1
+    changes["removed"] = len(set(previous_sections) - set(sections))
+
+    # সেকশনের সেট এবং CONTEXT_KEYWORDS একই থাকলে আগের কীওয়ার্ড ইনডেক্সই চলবে
+    if (previous_sections and set(previous_sections) == set(sections)
+            and previous.get("keywords_hash") == CONTEXT_KEYWORDS_HASH):
+        keyword_index = previous["keyword_index"]
+    else:
+        keyword_index = build_keyword_index(sections)
+
+    knowledge_base = {"format": KB_FORMAT, "source": business_info, "sections": sections,
+                      "keyword_index": keyword_index, "keywords_hash": CONTEXT_KEYWORDS_HASH}
+    return knowledge_base, changes
+
+def build_keyword_index(sections):
+    return [[key, keywords] for key, keywords in CONTEXT_KEYWORDS.items() if key in sections]
+
+def serialize_knowledge_base(knowledge_base):
+    return zlib.compress(json.dumps(knowledge_base, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+def deserialize_knowledge_base(snapshot):
+    knowledge_base = json.loads(zlib.decompress(snapshot).decode("utf-8"))
+    # অন্য CONTEXT_KEYWORDS দিয়ে কম্পাইল হওয়া স্ন্যাপশট: ইনডেক্স বর্তমান কীওয়ার্ড থেকে আবার তৈরি
+    if knowledge_base.get("keywords_hash") != CONTEXT_KEYWORDS_HASH:
+        knowledge_base["keyword_index"] = build_keyword_index(knowledge_base["sections"])
+        knowledge_base["keywords_hash"] = CONTEXT_KEYWORDS_HASH
+    return knowledge_base
+
+def knowledge_base_context(user_question, knowledge_base):
+    """কম্পাইল করা নলেজ বেস থেকে প্রশ্নের জন্য প্রাসঙ্গিক কন্টেক্সট বের করে"""
+    parsed_context = {key: section["text"] for key, section in knowledge_base["sections"].items()}
+    return get_dynamic_context(user_question, parsed_context, knowledge_base["keyword_index"])
+
+def save_knowledge_base(cursor, page_id, business_info):
+    """নতুন ভার্সনের স্ন্যাপশট সেভ করে এবং সক্রিয় করে; কমিট কলারের দায়িত্ব (একই ট্রানজ্যাকশনে থাকে)"""
+    # একই পেজে একসাথে দুটি সেভ হলে ভার্সন নম্বর যেন সংঘর্ষ না করে
+    cursor.execute('SELECT kb_version FROM companies WHERE page_id = %s FOR UPDATE', (page_id,))
+    current_version = cursor.fetchone()[0]
+    previous = None
+    if current_version is not None:
+        cursor.execute(KB_SNAPSHOT_SQL, (page_id, current_version))
+        row = cursor.fetchone()
+        if row:
+            previous = deserialize_knowledge_base(row[0])
+
+    # কনটেন্ট না বদলালে নতুন ভার্সন তৈরির দরকার নেই
+    if previous and previous.get("source") == business_info:
+        return current_version, None
+
+    knowledge_base, changes = compile_knowledge_base(business_info, previous)
+    cursor.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM kb_snapshots WHERE page_id = %s', (page_id,))
+    version = cursor.fetchone()[0]
+    cursor.execute('INSERT INTO kb_snapshots (page_id, version, snapshot) VALUES (%s, %s, %s)',
+                   (page_id, version, psycopg2.Binary(serialize_knowledge_base(knowledge_base))))
+    cursor.execute('UPDATE companies SET kb_version = %s WHERE page_id = %s', (version, page_id))
+    cursor.execute('DELETE FROM kb_snapshots WHERE page_id = %s AND version <= %s', (page_id, version - KB_SNAPSHOT_RETENTION))
+    logging.info(f"Compiled knowledge base v{version} for {page_id}: {changes}")
+    return version, changes
+
+def cached_knowledge_base(page_id, company_config):
+    """ক্যাশে সক্রিয় ভার্সনটি থাকলে ফেরত দেয়; স্ন্যাপশট না থাকলে (পুরনো রো) business_info থেকে কম্পাইল করে"""
+    version = company_config.get("kb_version")
+    if version is None:
+        return compile_knowledge_base(company_config.get("business_info") or "")[0]
+    cached = knowledge_base_cache.get(page_id)
+    if cached and cached[0] == version:
+        return cached[1]
+    return None
+
+def load_knowledge_base(page_id, company_config, snapshot):
+    """ডাটাবেস থেকে আনা স্ন্যাপশট ডিকোড করে ক্যাশে বসায়"""
+    if snapshot is None:
+        logging.warning(f"Knowledge base snapshot v{company_config['kb_version']} missing for {page_id}; compiling from business_info")
+        return compile_knowledge_base(company_config.get("business_info") or "")[0]
+    knowledge_base = deserialize_knowledge_base(snapshot)
+    knowledge_base_cache[page_id] = (company_config["kb_version"], knowledge_base)
+    return knowledge_base
+
+def get_knowledge_base(page_id, company_config):
+    """পেজের সক্রিয় নলেজ বেস (ক্যাশ থেকে, না থাকলে স্ন্যাপশট লোড করে)"""
+    knowledge_base = cached_knowledge_base(page_id, company_config)
+    if knowledge_base is not None:
+        return knowledge_base
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(KB_SNAPSHOT_SQL, (page_id, company_config["kb_version"]))
+        row = cursor.fetchone()
+    return load_knowledge_base(page_id, company_config, row[0] if row else None)
+
+def compile_missing_knowledge_bases():
+    """যেসব কোম্পানির এখনো স্ন্যাপশট নেই সেগুলো কম্পাইল করে (মাইগ্রেশনের অংশ)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT page_id, business_info FROM companies WHERE kb_version IS NULL')
+        for page_id, business_info in cursor.fetchall():
+            save_knowledge_base(cursor, page_id, business_info or "")
+        conn.commit()
+
 def get_facebook_user_name(sender_id, access_token):
     """ফেসবুক গ্রাফ এপিআই থেকে ইউজারের নাম সংগ্রহ করে"""
     try:
-        url = f"https://graph.facebook.com/{FACEBOOK_API_VERSION}/{sender_id}?fields=first_name,last_name&access_token={access_token}"
+        url = f"{GRAPH_API_URL}/{FACEBOOK_API_VERSION}/{sender_id}?fields=first_name,last_name&access_token={access_token}"
         response = requests.get(url)
         if response.status_code == 200:
             data = response.json()
@@ -318,7 +804,12 @@ def get_facebook_user_name(sender_id, access_token):
         logging.error(f"Failed to fetch user name: {e}")
     return None
 
-def ask_speednet_ai(user_question, summary, dynamic_context, bot_name, isp_user_id=None, user_name=None):
+# ৪. ফলব্যাক লজিক: এআই রেসপন্স ফেইল করলে বিকল্প উত্তর
+BUSY_FALLBACK_MESSAGE = "দুঃখিত, আমি এই মুহূর্তে একটু বেশি ব্যস্ত। জরুরি প্রয়োজনে আমাদের হটলাইনে (09639333111) কল করুন অথবা আপনার নম্বরটি দিন, আমরা কল ব্যাক করছি।"
+TENANT_THROTTLED_MESSAGE = "দুঃখিত, এই মুহূর্তে অনেক বেশি মেসেজ আসছে। জরুরি প্রয়োজনে আমাদের হটলাইনে (09639333111) কল করুন অথবা আপনার নম্বরটি দিন, আমরা কল ব্যাক করছি।"
+
+def build_ai_request(user_question, summary, dynamic_context, bot_name, isp_user_id=None, user_name=None):
+    """সিস্টেম প্রম্পটসহ উত্তর তৈরির Groq রিকোয়েস্টের প্যারামিটার তৈরি করে"""
     # টোকেন ম্যানেজমেন্ট নোট:
     # এখন ব্যবহারকারীর প্রশ্নের উপর ভিত্তি করে ডাটাবেস থেকে শুধুমাত্র প্রাসঙ্গিক অংশ (Dynamic Context) পাঠানো হচ্ছে।
     # এটি টোকেন ব্যবহার কমায় এবং অপ্রাসঙ্গিক তথ্য পাঠানো থেকে বিরত থাকে।
@@ -366,18 +857,25 @@ f"১৫. **ইউজার প্রোফাইলিং:** যদি গ্
     # messages.extend(history) # কনভারসেশনাল সামারি ব্যবহারের জন্য সম্পূর্ণ হিস্ট্রি পাঠানো বন্ধ করা হয়েছে।
     messages.append({"role": "user", "content": user_question})
 
+    return {
+        "messages": messages,
+        "model": "llama-3.1-8b-instant",
+        "max_tokens": 450,
+        "temperature": 0.5,
+    }
+
+def ask_speednet_ai(user_question, summary, dynamic_context, bot_name, isp_user_id=None, user_name=None, page_id=None, company_config=None):
+    request_kwargs = build_ai_request(user_question, summary, dynamic_context, bot_name, isp_user_id, user_name)
     try:
-        completion = client.chat.completions.create(
-            messages=messages,
-            model="llama-3.1-8b-instant",
-            max_tokens=450,
-            temperature=0.5
-        )
+        completion = groq_completion(page_id, company_config, **request_kwargs)
         return completion.choices[0].message.content
+    except TenantBudgetExceeded as e:
+        # নয়েজি পেজ: LLM-এ না পাঠিয়ে ক্যানড উত্তর, যাতে অন্য পেজগুলোর ল্যাটেন্সি স্বাভাবিক থাকে
+        logging.warning(f"Tenant throttled ({e}). Sending canned response.")
+        return TENANT_THROTTLED_MESSAGE
     except Exception as e:
         logging.error(f"Groq API Error: {e}")
-        # ৪. ফলব্যাক লজিক: এআই রেসপন্স ফেইল করলে বিকল্প উত্তর
-        return "দুঃখিত, আমি এই মুহূর্তে একটু বেশি ব্যস্ত। জরুরি প্রয়োজনে আমাদের হটলাইনে (09639333111) কল করুন অথবা আপনার নম্বরটি দিন, আমরা কল ব্যাক করছি।"
+        return BUSY_FALLBACK_MESSAGE
 
 # --- ফেসবুক ভেরিফিকেশন (GET) ---
 @app.route("/webhook", methods=["GET"])
@@ -387,90 +885,94 @@ def verify():
         return request.args.get("hub.challenge")
     return "Verification Token Mismatch", 403
 
+def iter_incoming_messages(data):
+    """ওয়েবহুক পেলোড থেকে (page_id, sender_id, message_text) বের করে; টেক্সট না থাকলে message_text None"""
+    if data.get("object") != "page":
+        return
+    for entry in data.get("entry", []):
+        for messaging_event in entry.get("messaging", []):
+            if messaging_event.get("message"):
+                # ১. মাল্টি-টেন্যান্ট হ্যান্ডলিং: recipient_id (Page ID) চেক করা
+                recipient_id = messaging_event.get("recipient", {}).get("id")
+                sender_id = messaging_event["sender"]["id"]
+                message = messaging_event["message"]
+
+                # কুইক রিপ্লাই বাটন ক্লিক হলে payload থেকে টেক্সট নেওয়া হয়
+                if message.get("quick_reply"):
+                    message_text = message["quick_reply"]["payload"]
+                else:
+                    message_text = message.get("text")
+                yield recipient_id, sender_id, message_text
+
+# যদি টেক্সট মেসেজ না হয়, কুইক রিপ্লাই সহ উত্তর পাঠানো
+NON_TEXT_REPLY = "দুঃখিত, আমি শুধু টেক্সট মেসেজ বুঝতে পারি।"
+NON_TEXT_QUICK_REPLIES = [
+    {
+        "content_type": "text",
+        "title": "📦 প্যাকেজ দেখুন",
+        "payload": "প্যাকেজগুলো দেখান",
+    },
+    {
+        "content_type": "text",
+        "title": "📞 কাস্টমার সাপোর্ট",
+        "payload": "কাস্টমার সাপোর্টে কথা বলতে চাই",
+    }
+]
+
 # --- ফেসবুক মেসেজ রিসিভ এবং রিপ্লাই (POST) ---
 @app.route("/webhook", methods=["POST"])
 def webhook():
     data = request.json
-    if data.get("object") == "page":
-        for entry in data.get("entry", []):
-            for messaging_event in entry.get("messaging", []):
-                if messaging_event.get("message"):
-                    # ১. মাল্টি-টেন্যান্ট হ্যান্ডলিং: recipient_id (Page ID) চেক করা
-                    recipient_id = messaging_event.get("recipient", {}).get("id")
-                    sender_id = messaging_event["sender"]["id"]
-                    message = messaging_event["message"]
-
-                    # কোম্পানি কনফিগারেশন লোড করা
-                    company_config = get_company_config(recipient_id)
-                    if not company_config:
-                        logging.warning(f"Unknown Page ID: {recipient_id}. Ignoring message.")
-                        continue
-
-                    # কুইক রিপ্লাই বাটন ক্লিক হলে payload থেকে টেক্সট নেওয়া হয়
-                    if message.get("quick_reply"):
-                        message_text = message["quick_reply"]["payload"]
-                    else:
-                        message_text = message.get("text")
-
-                    if message_text:
-                        # ব্যাকগ্রাউন্ডে মেসেজ প্রসেস করার জন্য থ্রেড তৈরি
-                        thread = threading.Thread(target=process_message, args=(recipient_id, sender_id, message_text, company_config))
-                        thread.start()
-                    else:
-                        # যদি টেক্সট মেসেজ না হয়, কুইক রিপ্লাই সহ উত্তর পাঠানো
-                        quick_replies = [
-                            {
-                                "content_type": "text",
-                                "title": "📦 প্যাকেজ দেখুন",
-                                "payload": "প্যাকেজগুলো দেখান",
-                            },
-                            {
-                                "content_type": "text",
-                                "title": "📞 কাস্টমার সাপোর্ট",
-                                "payload": "কাস্টমার সাপোর্টে কথা বলতে চাই",
-                            }
-                        ]
-                        send_message(sender_id, "দুঃখিত, আমি শুধু টেক্সট মেসেজ বুঝতে পারি।", company_config['access_token'], quick_replies)
+    for recipient_id, sender_id, message_text in iter_incoming_messages(data):
+        # কোম্পানি কনফিগারেশন লোড করা
+        company_config = get_company_config(recipient_id)
+        if not company_config:
+            logging.warning(f"Unknown Page ID: {recipient_id}. Ignoring message.")
+            continue
+
+        if message_text:
+            # ব্যাকগ্রাউন্ডে মেসেজ প্রসেস করার জন্য থ্রেড তৈরি
+            thread = threading.Thread(target=process_message, args=(recipient_id, sender_id, message_text, company_config))
+            thread.start()
+        else:
+            send_message(sender_id, NON_TEXT_REPLY, company_config['access_token'], NON_TEXT_QUICK_REPLIES)
 
     return "EVENT_RECEIVED", 200
 
-def process_message(page_id, sender_id, message_text, company_config):
-    """Handles incoming messages with throttling, keyword routing, and AI processing."""
-    access_token = company_config['access_token']
-    business_info = company_config['business_info']
-    bot_name = company_config['bot_name']
-
-    # ৫. থ্রোটলিং: ইন-মেমোরি ডিকশনারি ব্যবহার করে
+def is_throttled(sender_id):
+    """একই ইউজার THROTTLE_SECONDS-এর মধ্যে আবার মেসেজ দিলে True ফেরত দেয়"""
     current_time = time.time()
     if sender_id in user_last_message_time and current_time - user_last_message_time[sender_id] < THROTTLE_SECONDS:
         logging.warning(f"Throttling user {sender_id}. Ignoring message.")
-        return # কোনো রিপ্লাই না দিয়ে тихо থাকা
+        return True # কোনো রিপ্লাই না দিয়ে тихо থাকা
     user_last_message_time[sender_id] = current_time
+    return False
 
-    # ২. ইউজার প্রোফাইলিং: ইউজার আইডি শনাক্তকরণ এবং সেভ করা
+def extract_isp_user_id(message_text):
+    """মেসেজ থেকে ISP ইউজার আইডি খুঁজে বের করে (না পেলে None)"""
     # উদাহরণ: "আমার আইডি xyz123" বা "id: xyz123"
     match = re.search(r'(?i)(id|আইডি)\s*[:is\s]*([a-zA-Z0-9\-_]+)', message_text)
-    if match:
-        isp_id = match.group(2)
-        save_isp_user_id(page_id, sender_id, isp_id)
-        response_text = f"ধন্যবাদ! আপনার ইউজার আইডি '{isp_id}' সেভ করা হয়েছে। এখন থেকে আপনার অ্যাকাউন্টের বিষয়ে দ্রুত সহায়তা করতে পারব।"
-        add_message_to_history(page_id, sender_id, "user", message_text)
-        add_message_to_history(page_id, sender_id, "assistant", response_text)
-        send_message_with_quick_replies(sender_id, response_text, access_token)
-        return
+    return match.group(2) if match else None
 
-    # ৪. সাধারণ সম্ভাষণ ফিল্টার
-    GREETINGS = {
-        "hi": "হ্যালো! স্পিডনেট খুলনায় আপনাকে স্বাগতম। আমি স্পিডি, আপনার ডিজিটাল অ্যাসিস্ট্যান্ট।",
-        "hello": "জি, হ্যালো! আমি স্পিডি। কীভাবে আপনাকে সাহায্য করতে পারি?",
-        "কেমন আছেন": "ধন্যবাদ, আমি ভালো আছি। আপনার সেবায় আমি حاضر।",
-    }
+ISP_ID_SAVED_MESSAGE = "ধন্যবাদ! আপনার ইউজার আইডি '{}' সেভ করা হয়েছে। এখন থেকে আপনার অ্যাকাউন্টের বিষয়ে দ্রুত সহায়তা করতে পারব।"
+
+# ৪. সাধারণ সম্ভাষণ ফিল্টার
+GREETINGS = {
+    "hi": "হ্যালো! স্পিডনেট খুলনায় আপনাকে স্বাগতম। আমি স্পিডি, আপনার ডিজিটাল অ্যাসিস্ট্যান্ট।",
+    "hello": "জি, হ্যালো! আমি স্পিডি। কীভাবে আপনাকে সাহায্য করতে পারি?",
+    "কেমন আছেন": "ধন্যবাদ, আমি ভালো আছি। আপনার সেবায় আমি حاضر।",
+}
+
+# অন্যান্য কীওয়ার্ডের জন্য ফিক্সড উত্তর
+FIXED_RESPONSES = {
+    "বিল দেওয়ার নিয়ম": "আমাদের বিল বিকাশে অথবা নগদে পেমেন্ট করতে পারেন।\n\nbKash Payment:\n1. bKash App থেকে Pay Bill সিলেক্ট করুন\n2. Merchant No: 01400003070\n3. Amount + 1.5% চার্জ দিন\n4. Reference-এ আপনার Billing ID দিন\n5. PIN দিয়ে কনফার্ম করুন।",
+    "অফিস কোথায়?": "আমাদের অফিস ৮৩/৩, গগন বাবু রোড, খুলনা। যেকোনো প্রয়োজনে অফিস চলাকালীন সময়ে আসতে পারেন।",
+}
+
+def get_canned_reply(message_text):
+    """সম্ভাষণ ও কীওয়ার্ডের জন্য নির্দিষ্ট উত্তর ফেরত দেয়; AI-এর প্রয়োজন হলে None"""
     if message_text.lower() in GREETINGS:
-        response_text = GREETINGS[message_text.lower()]
-        add_message_to_history(page_id, sender_id, "user", message_text)
-        add_message_to_history(page_id, sender_id, "assistant", response_text)
-        send_message_with_quick_replies(sender_id, response_text, access_token)
-        return
+        return GREETINGS[message_text.lower()]
 
     # ১. কীওয়ার্ড-বেজড রাউটিং এবং ইমেজ সাপোর্ট
     message_lower = message_text.lower()
@@ -492,22 +994,34 @@ def process_message(page_id, sender_id, message_text, company_config):
             "- 20 Mbps ➝ মাত্র 525 টাকা (ভ্যাট সহ)\n- 30 Mbps ➝ মাত্র 630 টাকা (ভ্যাট সহ)\n- 50 Mbps ➝ মাত্র 785 টাকা (ভ্যাট সহ)\n- 80 Mbps ➝ মাত্র 1050 টাকা (ভ্যাট সহ)\n- 100 Mbps ➝ মাত্র 1205 টাকা (ভ্যাট সহ)\n- 150 Mbps ➝ মাত্র 1730 টাকা (ভ্যাট সহ)\n\n"
             "সব প্যাকেজে YouTube/BDIX/Facebook/FTP স্পিড 100 Mbps পর্যন্ত পাওয়া যায়।"
         )
-        send_message_with_quick_replies(sender_id, package_text, access_token)
-        add_message_to_history(page_id, sender_id, "user", message_text)
-        add_message_to_history(page_id, sender_id, "assistant", package_text)
-        return
+        return package_text
 
-    # অন্যান্য কীওয়ার্ডের জন্য ফিক্সড উত্তর
-    FIXED_RESPONSES = {
-        "বিল দেওয়ার নিয়ম": "আমাদের বিল বিকাশে অথবা নগদে পেমেন্ট করতে পারেন।\n\nbKash Payment:\n1. bKash App থেকে Pay Bill সিলেক্ট করুন\n2. Merchant No: 01400003070\n3. Amount + 1.5% চার্জ দিন\n4. Reference-এ আপনার Billing ID দিন\n5. PIN দিয়ে কনফার্ম করুন।",
-        "অফিস কোথায়?": "আমাদের অফিস ৮৩/৩, গগন বাবু রোড, খুলনা। যেকোনো প্রয়োজনে অফিস চলাকালীন সময়ে আসতে পারেন।",
-    }
     for keyword, response in FIXED_RESPONSES.items():
         if keyword in message_text:
-            add_message_to_history(page_id, sender_id, "user", message_text)
-            add_message_to_history(page_id, sender_id, "assistant", response)
-            send_message_with_quick_replies(sender_id, response, access_token)
-            return
+            return response
+    return None
+
+def process_message(page_id, sender_id, message_text, company_config):
+    """Handles incoming messages with throttling, keyword routing, and AI processing."""
+    access_token = company_config['access_token']
+    bot_name = company_config['bot_name']
+
+    # ৫. থ্রোটলিং: ইন-মেমোরি ডিকশনারি ব্যবহার করে
+    if is_throttled(sender_id):
+        return
+
+    # ২. ইউজার প্রোফাইলিং: ইউজার আইডি শনাক্তকরণ এবং সেভ করা
+    isp_id = extract_isp_user_id(message_text)
+    if isp_id:
+        save_isp_user_id(page_id, sender_id, isp_id)
+        response_text = ISP_ID_SAVED_MESSAGE.format(isp_id)
+    else:
+        response_text = get_canned_reply(message_text)
+    if response_text:
+        add_message_to_history(page_id, sender_id, "user", message_text)
+        add_message_to_history(page_id, sender_id, "assistant", response_text)
+        send_message_with_quick_replies(sender_id, response_text, access_token)
+        return
 
     try:
         # টাইপিং ইন্ডিকেটর চালু করা
@@ -526,12 +1040,12 @@ def process_message(page_id, sender_id, message_text, company_config):
                 update_user_name(page_id, sender_id, user_name)
         
         # ২. ডাইনামিক কন্টেক্সট লোডিং
-        # কোম্পানির বিজনেস ইনফো পার্স করা (SaaS-এর জন্য এটি প্রতি রিকোয়েস্টে বা ক্যাশ থেকে হতে পারে)
-        parsed_context = parse_isp_context(business_info)
-        dynamic_context = get_dynamic_context(message_text, parsed_context)
+        # /register-এ কম্পাইল করা নলেজ বেস স্ন্যাপশট থেকে (ওয়ার্কারে ক্যাশ করা থাকে)
+        knowledge_base = get_knowledge_base(page_id, company_config)
+        dynamic_context = knowledge_base_context(message_text, knowledge_base)
         
         # AI থেকে উত্তর নেওয়া
-        response_text = ask_speednet_ai(message_text, summary, dynamic_context, bot_name, isp_user_id, user_name)
+        response_text = ask_speednet_ai(message_text, summary, dynamic_context, bot_name, isp_user_id, user_name, page_id, company_config)
         
         # বর্তমান ইউজারের মেসেজ এবং AI-এর উত্তর ডাটাবেসে সেভ করা
         add_message_to_history(page_id, sender_id, "user", message_text)
@@ -544,40 +1058,41 @@ def process_message(page_id, sender_id, message_text, company_config):
         send_message_with_quick_replies(sender_id, response_text, access_token)
     
         # পুরনো মেসেজ সামারি এবং ক্লিনআপ (ব্যাকগ্রাউন্ডে চলবে)
-        prune_and_summarize(page_id, sender_id)
+        prune_and_summarize(page_id, sender_id, company_config)
 
     except Exception as e:
         logging.error(f"Error in process_message AI block: {e}")
         send_action(sender_id, "typing_off", access_token)
         # ৪. ফলব্যাক লজিক: এআই রেসপন্স ফেইল করলে বিকল্প উত্তর
-        fallback_message = "দুঃখিত, আমি এই মুহূর্তে একটু বেশি ব্যস্ত। জরুরি প্রয়োজনে আমাদের হটলাইনে (09639333111) কল করুন অথবা আপনার নম্বরটি দিন, আমরা কল ব্যাক করছি।"
+        fallback_message = BUSY_FALLBACK_MESSAGE
         send_message_with_quick_replies(sender_id, fallback_message, access_token)
 
+DEFAULT_QUICK_REPLIES = [
+    {
+        "content_type": "text",
+        "title": "📦 প্যাকেজ দেখুন",
+        "payload": "প্যাকেজ",
+    },
+    {
+        "content_type": "text",
+        "title": "💳 বিল দেওয়ার নিয়ম",
+        "payload": "বিল দেওয়ার নিয়ম",
+    },
+    {
+        "content_type": "text",
+        "title": "🏢 অফিস কোথায়?",
+        "payload": "অফিস কোথায়?",
+    },
+    {
+        "content_type": "text",
+        "title": "� কাস্টমার সাপোর্ট",
+        "payload": "কাস্টমার সাপোর্টে কথা বলতে চাই",
+    }
+]
+
 def send_message_with_quick_replies(recipient_id, message_text, access_token):
     """কুইক রিপ্লাই বাটনসহ মেসেজ পাঠায়"""
-    quick_replies = [
-        {
-            "content_type": "text",
-            "title": "📦 প্যাকেজ দেখুন",
-            "payload": "প্যাকেজ",
-        },
-        {
-            "content_type": "text",
-            "title": "💳 বিল দেওয়ার নিয়ম",
-            "payload": "বিল দেওয়ার নিয়ম",
-        },
-        {
-            "content_type": "text",
-            "title": "🏢 অফিস কোথায়?",
-            "payload": "অফিস কোথায়?",
-        },
-        {
-            "content_type": "text",
-            "title": "� কাস্টমার সাপোর্ট",
-            "payload": "কাস্টমার সাপোর্টে কথা বলতে চাই",
-        }
-    ]
-    send_message(recipient_id, message_text, access_token, quick_replies)
+    send_message(recipient_id, message_text, access_token, DEFAULT_QUICK_REPLIES)
 
 def send_message(recipient_id, message_text, access_token, quick_replies=None):
     params = {"access_token": access_token}
@@ -588,7 +1103,7 @@ def send_message(recipient_id, message_text, access_token, quick_replies=None):
 
     data = {"recipient": {"id": recipient_id}, "message": message_data}
     try:
-        response = requests.post(f"https://graph.facebook.com/{FACEBOOK_API_VERSION}/me/messages", params=params, headers=headers, json=data)
+        response = requests.post(f"{GRAPH_API_URL}/{FACEBOOK_API_VERSION}/me/messages", params=params, headers=headers, json=data)
         response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
         logging.info(f"Message sent to {recipient_id}")
     except requests.exceptions.RequestException as e:
@@ -612,7 +1127,7 @@ def send_image(recipient_id, image_url, access_token, text_after_image=None):
         }
     }
     try:
-        response = requests.post(f"https://graph.facebook.com/{FACEBOOK_API_VERSION}/me/messages", params=params, headers=headers, json=image_data)
+        response = requests.post(f"{GRAPH_API_URL}/{FACEBOOK_API_VERSION}/me/messages", params=params, headers=headers, json=image_data)
         response.raise_for_status()
         logging.info(f"Image sent to {recipient_id}")
     except requests.exceptions.RequestException as e:
@@ -629,7 +1144,7 @@ def send_action(recipient_id, action, access_token):
     headers = {"Content-Type": "application/json"}
     data = {"recipient": {"id": recipient_id}, "sender_action": action}
     try:
-        requests.post(f"https://graph.facebook.com/{FACEBOOK_API_VERSION}/me/messages", params=params, headers=headers, json=data).raise_for_status()
+        requests.post(f"{GRAPH_API_URL}/{FACEBOOK_API_VERSION}/me/messages", params=params, headers=headers, json=data).raise_for_status()
     except requests.exceptions.RequestException as e:
         logging.error(f"Error sending action to {recipient_id}: {e}")
 
@@ -658,12 +1173,18 @@ def test_chat():
     if not message_text or not business_info:
         return jsonify({"error": "Message and Business Info required"}), 400
 
-    # ডাইনামিক কন্টেক্সট পার্সিং (সরাসরি ইনপুট থেকে)
-    parsed_context = parse_isp_context(business_info)
-    dynamic_context = get_dynamic_context(message_text, parsed_context)
+    # সেভ করা ভার্সনের মতোই কম্পাইল করে প্রিভিউ (সরাসরি ইনপুট থেকে)
+    knowledge_base, _ = compile_knowledge_base(business_info)
+    dynamic_context = knowledge_base_context(message_text, knowledge_base)
     
+    # প্রিভিউ যে পেজ ম্যানেজ করা হচ্ছে তার বাজেটে গণনা হয়, যাতে আলাদা পেজের অপারেটররা একে অপরকে থ্রোটল না করে
+    page_id = data.get("page_id")
+    company_config = get_company_config(page_id) if page_id else None
+    if not company_config:
+        page_id = None
+
     # এআই রেসপন্স জেনারেট (সামারি ছাড়া, কারণ এটি টেস্ট)
-    response_text = ask_speednet_ai(message_text, "", dynamic_context, bot_name, None, "Test User")
+    response_text = ask_speednet_ai(message_text, "", dynamic_context, bot_name, None, "Test User", page_id, company_config)
     
     return jsonify({"response": response_text})
 
@@ -676,11 +1197,12 @@ def disconnect_page():
     if not page_id:
         return jsonify({"error": "Page ID required"}), 400
         
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM companies WHERE page_id = %s', (page_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM companies WHERE page_id = %s', (page_id,))
+        cursor.execute('DELETE FROM kb_snapshots WHERE page_id = %s', (page_id,))
+        conn.commit()
+        knowledge_base_cache.pop(page_id, None)
     return jsonify({"status": "success", "message": "Page disconnected successfully."}), 200
 
 @app.route("/manage/<page_id>")
@@ -688,27 +1210,196 @@ def manage_page(page_id):
     """Specific dashboard page for a connected page"""
     return render_template("manage.html", app_id=FACEBOOK_APP_ID, page_id=page_id)
 
+# --- Admin APIs (Paginated, Conditional GET) ---
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 200
+GZIP_MIN_SIZE = 1024
+
+def get_page_limit():
+    """?limit= প্যারামিটার পড়ে সীমার মধ্যে রাখে"""
+    limit = request.args.get("limit", ADMIN_PAGE_SIZE, type=int)
+    return max(1, min(limit, ADMIN_MAX_PAGE_SIZE))
+
+def conditional_json(payload):
+    """ETag সহ JSON রেসপন্স; ক্লায়েন্টের কপি একই থাকলে 304 ফেরত দেয়"""
+    response = jsonify(payload)
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.after_request
+def compress_response(response):
+    """বড় JSON/HTML রেসপন্স gzip করে পাঠায়"""
+    if (response.direct_passthrough or response.status_code != 200
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in ("application/json", "text/html")
+            or "gzip" not in request.headers.get("Accept-Encoding", "").lower()):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    # কম্প্রেস করা রিপ্রেজেন্টেশনের জন্য weak ETag
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        response.headers["ETag"] = f"W/{etag}"
+    return response
+
 @app.route("/api/company/<page_id>")
 def get_company_api(page_id):
     """Returns config for a specific page to populate the dashboard"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute('SELECT business_info, bot_name, page_name FROM companies WHERE page_id = %s', (page_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return jsonify(row)
-    return jsonify({}), 404
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # ক্লায়েন্টের কাছে ক্যাশ থাকলে বড় business_info না পড়ে শুধু updated_at দিয়ে যাচাই
+        if request.if_none_match:
+            cursor.execute('SELECT updated_at FROM companies WHERE page_id = %s', (page_id,))
+            row = cursor.fetchone()
+            if row and request.if_none_match.contains_weak(f"{page_id}-{row['updated_at'].timestamp()}"):
+                response = app.response_class(status=304)
+                response.set_etag(f"{page_id}-{row['updated_at'].timestamp()}")
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+                return response
+        cursor.execute('SELECT business_info, bot_name, page_name, kb_version, updated_at FROM companies WHERE page_id = %s', (page_id,))
+        row = cursor.fetchone()
+    if not row:
+        return jsonify({}), 404
+    updated_at = row.pop("updated_at")
+    response = jsonify(row)
+    response.set_etag(f"{page_id}-{updated_at.timestamp()}")
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route("/api/company/<page_id>/kb/versions")
+def list_kb_versions(page_id):
+    """পেজের সংরক্ষিত নলেজ বেস ভার্সনগুলোর তালিকা (নতুন থেকে পুরনো)"""
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute('SELECT kb_version FROM companies WHERE page_id = %s', (page_id,))
+        company = cursor.fetchone()
+        if not company:
+            return jsonify({"error": "Company not found"}), 404
+        cursor.execute('''
+            SELECT version, created_at, octet_length(snapshot) AS size_bytes
+            FROM kb_snapshots WHERE page_id = %s ORDER BY version DESC
+        ''', (page_id,))
+        versions = cursor.fetchall()
+    for version in versions:
+        version["created_at"] = version["created_at"].isoformat()
+    return conditional_json({"active_version": company["kb_version"], "versions": versions})
+
+@app.route("/api/company/<page_id>/kb/rollback", methods=["POST"])
+def rollback_kb(page_id):
+    """সক্রিয় নলেজ বেস আগের (বা নির্দিষ্ট) ভার্সনে ফিরিয়ে নেয়; business_info-ও সেই ভার্সনের মতো হয়"""
+    data = request.get_json(silent=True) or {}
+    version = data.get("version")
+    if version is not None:
+        try:
+            version = int(version)
+        except (TypeError, ValueError):
+            return jsonify({"error": "version must be an integer"}), 400
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT kb_version FROM companies WHERE page_id = %s FOR UPDATE', (page_id,))
+        company = cursor.fetchone()
+        if not company:
+            return jsonify({"error": "Company not found"}), 404
+        if version is None:
+            cursor.execute('SELECT MAX(version) FROM kb_snapshots WHERE page_id = %s AND version < %s', (page_id, company[0] or 0))
+            version = cursor.fetchone()[0]
+            if version is None:
+                return jsonify({"error": "No earlier version to roll back to"}), 409
+        cursor.execute(KB_SNAPSHOT_SQL, (page_id, version))
+        row = cursor.fetchone()
+        if not row:
+            return jsonify({"error": f"Version {version} not found"}), 404
+        knowledge_base = deserialize_knowledge_base(row[0])
+        # রোলব্যাক নতুন ভার্সন তৈরি করে না; শুধু পয়েন্টার বদলায়, ওয়ার্কাররা পরের মেসেজে নতুন স্ন্যাপশট লোড করে
+        cursor.execute(
+            'UPDATE companies SET kb_version = %s, business_info = %s, updated_at = CURRENT_TIMESTAMP WHERE page_id = %s',
+            (version, knowledge_base["source"], page_id),
+        )
+        conn.commit()
+    knowledge_base_cache[page_id] = (version, knowledge_base)
+    logging.info(f"Rolled back knowledge base for {page_id} to v{version}")
+    return jsonify({"status": "success", "kb_version": version})
+
+@app.route("/api/company/<page_id>/conversations")
+def list_conversations(page_id):
+    """পেজের কথোপকথন (সামারিসহ) sender_id অনুযায়ী keyset পেজিনেশনে ফেরত দেয়"""
+    limit = get_page_limit()
+    after = request.args.get("after")
+    # summaries-এ সব সেন্ডারের রো থাকে না (যেমন শুধু ক্যানড উত্তর পাওয়া ইউজার), তাই তালিকা messages থেকে;
+    # (page_id, sender_id, id) ইনডেক্স ধরে চলে এবং প্রুনিংয়ের কারণে প্রতি সেন্ডারে মেসেজ সংখ্যা ছোট থাকে
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute('''
+            SELECT m.sender_id, s.user_name, s.isp_user_id, COALESCE(s.summary, '') AS summary
+            FROM (
+                SELECT DISTINCT sender_id FROM messages
+                WHERE page_id = %s AND sender_id > %s
+                ORDER BY sender_id LIMIT %s
+            ) m
+            LEFT JOIN summaries s ON s.sender_id = m.sender_id
+            ORDER BY m.sender_id
+        ''', (page_id, after or "", limit + 1))
+        rows = cursor.fetchall()
+    next_cursor = rows[limit - 1]["sender_id"] if len(rows) > limit else None
+    return conditional_json({"conversations": rows[:limit], "next_cursor": next_cursor})
+
+@app.route("/api/company/<page_id>/conversations/<sender_id>/messages")
+def list_conversation_messages(page_id, sender_id):
+    """একটি কথোপকথনের মেসেজ নতুন থেকে পুরনো ক্রমে keyset পেজিনেশনে ফেরত দেয়"""
+    limit = get_page_limit()
+    before = request.args.get("before", type=int)
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        if before:
+            cursor.execute('SELECT id, role, content, timestamp FROM messages WHERE page_id = %s AND sender_id = %s AND id < %s ORDER BY id DESC LIMIT %s', (page_id, sender_id, before, limit + 1))
+        else:
+            cursor.execute('SELECT id, role, content, timestamp FROM messages WHERE page_id = %s AND sender_id = %s ORDER BY id DESC LIMIT %s', (page_id, sender_id, limit + 1))
+        rows = cursor.fetchall()
+    for row in rows:
+        row["timestamp"] = row["timestamp"].isoformat() if row["timestamp"] else None
+    next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+    return conditional_json({"messages": rows[:limit], "next_cursor": next_cursor})
+
+@app.route("/api/usage")
+def usage_api():
+    """আজকের পেজভিত্তিক ব্যবহার (রিকোয়েস্ট, টোকেন, থ্রোটল) ড্যাশবোর্ডের জন্য ফেরত দেয় (?page_ids=a,b দিয়ে ফিল্টার)"""
+    page_ids = [p for p in request.args.get("page_ids", "").split(",") if p]
+    query = '''
+        SELECT c.page_id, COALESCE(u.requests, 0) AS requests, COALESCE(u.tokens, 0) AS tokens,
+               COALESCE(u.degraded, 0) AS degraded, COALESCE(c.daily_token_budget, %s) AS daily_token_budget
+        FROM companies c LEFT JOIN page_usage u ON u.page_id = c.page_id AND u.day = %s
+    '''
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        if page_ids:
+            cursor.execute(query + ' WHERE c.page_id IN %s', (TENANT_DAILY_TOKEN_BUDGET, usage_day(), tuple(page_ids)))
+        else:
+            cursor.execute(query, (TENANT_DAILY_TOKEN_BUDGET, usage_day()))
+        rows = cursor.fetchall()
+    return jsonify({row["page_id"]: row for row in rows})
 
 @app.route("/connected-pages")
 def connected_pages():
-    """Returns list of connected pages"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute('SELECT page_id, page_name, bot_name FROM companies ORDER BY id DESC')
-    pages = cursor.fetchall()
-    conn.close()
-    return jsonify(pages)
+    """Returns connected pages, newest first, with keyset pagination (?limit=&after=<id>)"""
+    limit = get_page_limit()
+    after = request.args.get("after", type=int)
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        if after:
+            cursor.execute('SELECT id, page_id, page_name, bot_name FROM companies WHERE id < %s ORDER BY id DESC LIMIT %s', (after, limit + 1))
+        else:
+            cursor.execute('SELECT id, page_id, page_name, bot_name FROM companies ORDER BY id DESC LIMIT %s', (limit + 1,))
+        pages = cursor.fetchall()
+    next_cursor = pages[limit - 1]["id"] if len(pages) > limit else None
+    return conditional_json({"pages": pages[:limit], "next_cursor": next_cursor})
 
 # --- Admin Route for SaaS (Optional) ---
 @app.route("/register", methods=["POST"])
@@ -729,13 +1420,15 @@ def register_company():
     try:
         cursor.execute('''
             INSERT INTO companies (page_id, access_token, business_info, bot_name, page_name) VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (page_id) DO UPDATE SET access_token = EXCLUDED.access_token, business_info = EXCLUDED.business_info, bot_name = EXCLUDED.bot_name, page_name = EXCLUDED.page_name
+            ON CONFLICT (page_id) DO UPDATE SET access_token = EXCLUDED.access_token, business_info = EXCLUDED.business_info, bot_name = EXCLUDED.bot_name, page_name = EXCLUDED.page_name, updated_at = CURRENT_TIMESTAMP
         ''', (page_id, access_token, business_info, bot_name, page_name))
+        # একই ট্রানজ্যাকশনে নলেজ বেস কম্পাইল, যাতে business_info এবং সক্রিয় স্ন্যাপশট সবসময় মিলে থাকে
+        kb_version, _ = save_knowledge_base(cursor, page_id, business_info)
         conn.commit()
 
         # --- অটোমেটিক সাবস্ক্রিপশন লজিক ---
         # পেজটিকে অ্যাপের সাথে সাবস্ক্রাইব করা হচ্ছে যাতে মেসেজ ওয়েবহুকে আসে
-        subscribe_url = f"https://graph.facebook.com/{FACEBOOK_API_VERSION}/{page_id}/subscribed_apps"
+        subscribe_url = f"{GRAPH_API_URL}/{FACEBOOK_API_VERSION}/{page_id}/subscribed_apps"
         subscribe_params = {
             "access_token": access_token,
             "subscribed_fields": "messages,messaging_postbacks"
@@ -744,20 +1437,48 @@ def register_company():
         if sub_resp.status_code != 200:
             logging.error(f"Failed to subscribe page {page_id}: {sub_resp.text}")
 
-        return jsonify({"status": "success", "message": f"Company {page_id} registered."}), 200
+        return jsonify({"status": "success", "message": f"Company {page_id} registered.", "kb_version": kb_version}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
-        conn.close()
-
-# --- Database Initialization (Run on App Startup) ---
-# Gunicorn বা প্রোডাকশন সার্ভারে __main__ ব্লক রান হয় না, তাই এখানে কল করতে হবে।
-try:
-    init_db()  # অ্যাপ চালু হওয়ার সময় ডাটাবেস ইনিশিয়ালাইজ করা
-    seed_db()  # ডিফল্ট কোম্পানি সিড করা
-    logging.info("Database initialized and seeded successfully.")
-except Exception as e:
-    logging.error(f"Startup DB Error: {e}")
+        release_db_connection(conn)
+
+# --- Database Migration CLI ---
+# ইমপোর্টের সময় ডাটাবেস বা ফেসবুকে কোনো কল হয় না; ডিপ্লয়ের সময় একবার চালাতে হবে:
+#   flask --app app migrate
+@app.cli.command("migrate")
+@click.option("--seed/--no-seed", default=True, help="PAGE_ACCESS_TOKEN থেকে ডিফল্ট কোম্পানি সিড করা হবে কি না")
+def migrate_command(seed):
+    """ডাটাবেস স্কিমা তৈরি/মাইগ্রেট করে এবং ডিফল্ট কোম্পানি সিড করে"""
+    init_db()
+    logging.info("Database initialized successfully.")
+    if seed:
+        seed_db()
+    compile_missing_knowledge_bases()
+
+# --- Health Checks ---
+@app.route("/healthz")
+def healthz():
+    """Liveness: প্রসেস সচল কি না (কোনো বাইরের নির্ভরতা যাচাই করে না)"""
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz")
+def readyz():
+    """Readiness: ডাটাবেসে কানেক্ট করা যায় এবং মাইগ্রেশন চালানো হয়েছে কি না"""
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT to_regclass('public.kb_snapshots') IS NOT NULL")
+            migrated = cursor.fetchone()[0]
+    except Exception as e:
+        logging.error(f"Readiness check failed: {e}")
+        return jsonify({"status": "unavailable", "error": "database unreachable"}), 503
+    if not migrated:
+        return jsonify({"status": "unavailable", "error": "migrations pending"}), 503
+    return jsonify({"status": "ready", "startup_ms": round(STARTUP_SECONDS * 1000)})
+
+STARTUP_SECONDS = time.perf_counter() - STARTUP_BEGAN
+logging.info(f"App module loaded in {STARTUP_SECONDS * 1000:.0f} ms")
 
 if __name__ == "__main__":
     print("--- স্পিড নেট এআই সার্ভার (Local) চালু হচ্ছে ---")
@@ -0,0 +1,417 @@
+"""
+Async (ASGI) সার্ভিং মোড।
+
+ওয়েবহুক এবং মেসেজ পাইপলাইন asyncio-তে চলে: ডাটাবেস (psycopg 3 async pool), Groq (AsyncGroq)
+এবং Graph API (httpx.AsyncClient) কলগুলো থ্রেড ব্লক করে না, তাই একটি প্রসেস নির্দিষ্ট মেমরিতে
+হাজার হাজার কথোপকথন একসাথে সামলাতে পারে। ড্যাশবোর্ড ও অ্যাডমিন API আগের Flask অ্যাপ থেকেই আসে।
+
+চালানো:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Sync মোড (gunicorn app:app) আগের মতোই চালু থাকে।
+"""
+import os
+import asyncio
+import logging
+import heapq
+from contextlib import asynccontextmanager
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route
+
+import app as sync_app
+from app import (
+    FACEBOOK_API_VERSION, GRAPH_API_TIMEOUT, GRAPH_API_URL, GROQ_API_KEY, VERIFY_TOKEN,
+    COMPANY_CONFIG_SQL, INSERT_MESSAGE_SQL, USER_PROFILE_SQL, UPSERT_USER_NAME_SQL, UPSERT_SUMMARY_SQL,
+    UPSERT_ISP_USER_ID_SQL, COUNT_MESSAGES_SQL, OLDEST_MESSAGES_SQL, DELETE_MESSAGES_SQL, RECORD_USAGE_SQL, PAGE_USAGE_SQL,
+    KB_SNAPSHOT_SQL, PRUNE_THRESHOLD, LLM_QUEUE_TIMEOUT, USAGE_FLUSH_SECONDS, BUSY_FALLBACK_MESSAGE, TENANT_THROTTLED_MESSAGE, ISP_ID_SAVED_MESSAGE,
+    NON_TEXT_REPLY, NON_TEXT_QUICK_REPLIES, DEFAULT_QUICK_REPLIES,
+    TenantBudgetExceeded, TenantScheduler, build_ai_request, build_summary_request, completion_limits,
+    cached_knowledge_base, extract_isp_user_id, get_canned_reply, is_throttled, iter_incoming_messages,
+    knowledge_base_context, load_knowledge_base, usage_day, user_profile_from_row,
+)
+
+# --- Async Configuration ---
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", 20))
+ASYNC_LLM_WORKERS = int(os.getenv("ASYNC_LLM_WORKERS", 32))
+# একসাথে প্রসেস হওয়া কথোপকথনের সংখ্যা (নির্দিষ্ট সংখ্যক ওয়ার্কার টাস্ক) এবং অপেক্ষমাণ মেসেজের সর্বোচ্চ সংখ্যা;
+# কিউ পূর্ণ হলে নতুন মেসেজ বাদ পড়ে, তাই বার্স্টেও মেমরি নির্দিষ্ট সীমায় থাকে
+ASYNC_MAX_CONVERSATIONS = int(os.getenv("ASYNC_MAX_CONVERSATIONS", 2000))
+ASYNC_QUEUE_SIZE = int(os.getenv("ASYNC_QUEUE_SIZE", 10000))
+
+db_pool = AsyncConnectionPool(os.getenv("DATABASE_URL", ""), min_size=1, max_size=ASYNC_DB_POOL_MAX,
+                              kwargs={"row_factory": dict_row}, open=False)
+http_client = None
+groq_client = None
+incoming_messages = None
+conversation_workers = []
+background_tasks = set()
+
+def get_async_groq_client():
+    """AsyncGroq ক্লায়েন্ট প্রথমবার দরকার হলে তৈরি করে"""
+    global groq_client
+    if groq_client is None:
+        from groq import AsyncGroq
+        groq_client = AsyncGroq(api_key=GROQ_API_KEY)
+    return groq_client
+
+# --- Async Database Helpers ---
+async def db_fetchone(sql, params):
+    async with db_pool.connection() as conn:
+        cursor = await conn.execute(sql, params)
+        return await cursor.fetchone()
+
+async def db_fetchall(sql, params):
+    async with db_pool.connection() as conn:
+        cursor = await conn.execute(sql, params)
+        return await cursor.fetchall()
+
+async def db_execute(sql, params):
+    # pool.connection() ব্লক শেষে নিজেই commit করে
+    async with db_pool.connection() as conn:
+        await conn.execute(sql, params)
+
+async def get_company_config(page_id):
+    return await db_fetchone(COMPANY_CONFIG_SQL, (page_id,))
+
+async def get_knowledge_base(page_id, company_config):
+    """সিঙ্ক মোডের মতোই; ক্যাশ (knowledge_base_cache) দুই মোডে একই"""
+    knowledge_base = cached_knowledge_base(page_id, company_config)
+    if knowledge_base is not None:
+        return knowledge_base
+    row = await db_fetchone(KB_SNAPSHOT_SQL, (page_id, company_config["kb_version"]))
+    return load_knowledge_base(page_id, company_config, row["snapshot"] if row else None)
+
+async def add_message_to_history(page_id, sender_id, role, content):
+    await db_execute(INSERT_MESSAGE_SQL, (page_id, sender_id, role, content))
+
+async def get_user_profile(page_id, sender_id):
+    return user_profile_from_row(await db_fetchone(USER_PROFILE_SQL, (sender_id,)))
+
+async def update_user_name(page_id, sender_id, user_name):
+    await db_execute(UPSERT_USER_NAME_SQL, (sender_id, page_id, user_name))
+
+async def save_summary(page_id, sender_id, summary):
+    await db_execute(UPSERT_SUMMARY_SQL, (sender_id, page_id, summary))
+
+async def save_isp_user_id(page_id, sender_id, isp_user_id):
+    await db_execute(UPSERT_ISP_USER_ID_SQL, (sender_id, page_id, isp_user_id))
+
+async def load_page_usage(page_id):
+    try:
+        return await db_fetchone(PAGE_USAGE_SQL, (page_id, usage_day())) or {}
+    except Exception as e:
+        logging.error(f"Failed to load usage for {page_id}: {e}")
+        return None
+
+async def record_page_usage(page_id, requests=0, tokens=0, degraded=0):
+    """আজকের ব্যবহার ডাটাবেসে যোগ করে এবং সব ওয়ার্কারের মোট টোকেন শিডিউলারে বসায়"""
+    day = usage_day()
+    try:
+        row = await db_fetchone(RECORD_USAGE_SQL, (page_id, day, requests, tokens, degraded))
+    except Exception as e:
+        logging.error(f"Failed to record usage for {page_id}: {e}")
+        return
+    llm_scheduler.merge_usage(page_id, row["tokens"], day)
+
+def run_in_background(coro):
+    """টাস্কের রেফারেন্স রেখে দেয় যাতে শেষ হওয়ার আগে garbage collect না হয়"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# --- Async Fair Scheduler ---
+class AsyncTenantScheduler(TenantScheduler):
+    """TenantScheduler-এর একই বাজেট ও weighted fair queue নিয়ম, তবে থ্রেডের বদলে asyncio টাস্ক দিয়ে চলে"""
+
+    def __init__(self, workers):
+        super().__init__(workers)
+        self.wakeup = None
+        self.tasks = []
+
+    async def run(self, page_id, call, weight=1, rpm_limit=sync_app.TENANT_RPM_LIMIT,
+                  token_budget=sync_app.TENANT_DAILY_TOKEN_BUDGET, cost=1, count_degraded=True):
+        """কলটি (coroutine factory) কিউতে রেখে ফলাফলের জন্য অপেক্ষা করে; বাজেট শেষ হলে TenantBudgetExceeded"""
+        if self.wakeup is None:
+            self.wakeup = asyncio.Condition()
+            for _ in range(self.workers):
+                self.tasks.append(asyncio.create_task(self._worker()))
+            self.tasks.append(asyncio.create_task(self._flusher()))
+        if self.needs_seed(page_id):
+            self.seed_usage(page_id, await load_page_usage(page_id))
+        with self.lock:
+            start, finish = self._admit(page_id, weight, rpm_limit, token_budget, cost, count_degraded)
+        future = asyncio.get_running_loop().create_future()
+        async with self.wakeup:
+            heapq.heappush(self.heap, (finish, self.seq, start, page_id, call, future))
+            self.seq += 1
+            self.wakeup.notify()
+        # সময় শেষ হলে future বাতিল হয়, ওয়ার্কার তখন কলটি এড়িয়ে যায়
+        return await asyncio.wait_for(future, LLM_QUEUE_TIMEOUT)
+
+    async def _worker(self):
+        while True:
+            async with self.wakeup:
+                while not self.heap:
+                    await self.wakeup.wait()
+                _, _, start, page_id, call, future = heapq.heappop(self.heap)
+            with self.lock:
+                self.virtual_time = max(self.virtual_time, start)
+
+            tokens = 0
+            ran = not future.done()
+            if ran:
+                try:
+                    result = await call()
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    usage = getattr(result, "usage", None)
+                    tokens = getattr(usage, "total_tokens", 0) or 0
+                    if not future.done():
+                        future.set_result(result)
+            self._done(page_id, tokens, ran)
+            if ran:
+                run_in_background(record_page_usage(page_id, requests=1, tokens=tokens))
+
+    async def flush_degraded(self):
+        for page_id, degraded in self.take_unflushed_degraded().items():
+            await record_page_usage(page_id, degraded=degraded)
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_SECONDS)
+            await self.flush_degraded()
+
+    async def stop(self):
+        """ওয়ার্কার ও ফ্লাশার টাস্কগুলো বাতিল করে সেগুলো শেষ হওয়া পর্যন্ত অপেক্ষা করে"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.wakeup = None
+
+llm_scheduler = AsyncTenantScheduler(ASYNC_LLM_WORKERS)
+
+async def groq_completion(page_id, company_config=None, count_degraded=True, **kwargs):
+    """sync groq_completion-এর async সংস্করণ"""
+    if not page_id:
+        return await get_async_groq_client().chat.completions.create(**kwargs)
+    return await llm_scheduler.run(
+        page_id,
+        lambda: get_async_groq_client().chat.completions.create(**kwargs),
+        count_degraded=count_degraded,
+        **completion_limits(company_config, kwargs)
+    )
+
+async def generate_summary(current_summary, new_lines, page_id=None, company_config=None):
+    """sync generate_summary-এর মতো: থ্রোটলড বা ব্যর্থ হলে None"""
+    try:
+        completion = await groq_completion(page_id, company_config, count_degraded=False,
+                                           **build_summary_request(current_summary, new_lines))
+        return completion.choices[0].message.content
+    except TenantBudgetExceeded:
+        logging.warning(f"Skipping summarization for page {page_id}: budget exhausted")
+        return None
+    except Exception as e:
+        logging.error(f"Summarization failed: {e}")
+        return None
+
+async def ask_speednet_ai(user_question, summary, dynamic_context, bot_name, isp_user_id=None, user_name=None, page_id=None, company_config=None):
+    request_kwargs = build_ai_request(user_question, summary, dynamic_context, bot_name, isp_user_id, user_name)
+    try:
+        completion = await groq_completion(page_id, company_config, **request_kwargs)
+        return completion.choices[0].message.content
+    except TenantBudgetExceeded as e:
+        logging.warning(f"Tenant throttled ({e}). Sending canned response.")
+        return TENANT_THROTTLED_MESSAGE
+    except Exception as e:
+        logging.error(f"Groq API Error: {e}")
+        return BUSY_FALLBACK_MESSAGE
+
+async def prune_and_summarize(page_id, sender_id, company_config=None):
+    """মেসেজ সংখ্যা বেশি হলে পুরনো মেসেজ সামারি করে ডিলিট করে (LLM কলের সময় কানেকশন ধরে রাখে না)"""
+    count = (await db_fetchone(COUNT_MESSAGES_SQL, (sender_id, page_id)))["count"]
+    if count <= PRUNE_THRESHOLD:
+        return
+    old_msgs = await db_fetchall(OLDEST_MESSAGES_SQL, (sender_id, page_id))
+    if not old_msgs:
+        return
+    ids_to_delete = [msg["id"] for msg in old_msgs]
+    text_to_summarize = "\n".join([f"{msg['role']}: {msg['content']}" for msg in old_msgs])
+    current_summary = (await get_user_profile(page_id, sender_id)).get("summary", "")
+    new_summary = await generate_summary(current_summary, text_to_summarize, page_id, company_config)
+    if new_summary is None:
+        return  # মেসেজগুলো থেকে যায়, পরের মেসেজে আবার চেষ্টা হবে
+    await save_summary(page_id, sender_id, new_summary)
+    await db_execute(DELETE_MESSAGES_SQL, (ids_to_delete,))
+    logging.info(f"Summarized and pruned {len(ids_to_delete)} messages for {sender_id}")
+
+# --- Async Graph API Helpers ---
+async def graph_post(payload, access_token, description):
+    try:
+        response = await http_client.post(f"{GRAPH_API_URL}/{FACEBOOK_API_VERSION}/me/messages",
+                                          params={"access_token": access_token}, json=payload)
+        response.raise_for_status()
+        return True
+    except httpx.HTTPStatusError as e:
+        logging.error(f"Error sending {description}: {e}")
+        logging.error(f"Response Body: {e.response.text}")
+    except httpx.HTTPError as e:
+        logging.error(f"Error sending {description}: {e}")
+    return False
+
+async def send_message(recipient_id, message_text, access_token, quick_replies=None):
+    message_data = {"text": message_text}
+    if quick_replies:
+        message_data["quick_replies"] = quick_replies
+    if await graph_post({"recipient": {"id": recipient_id}, "message": message_data}, access_token, f"message to {recipient_id}"):
+        logging.info(f"Message sent to {recipient_id}")
+
+async def send_message_with_quick_replies(recipient_id, message_text, access_token):
+    await send_message(recipient_id, message_text, access_token, DEFAULT_QUICK_REPLIES)
+
+async def send_action(recipient_id, action, access_token):
+    await graph_post({"recipient": {"id": recipient_id}, "sender_action": action}, access_token, f"action to {recipient_id}")
+
+async def get_facebook_user_name(sender_id, access_token):
+    try:
+        response = await http_client.get(f"{GRAPH_API_URL}/{FACEBOOK_API_VERSION}/{sender_id}",
+                                         params={"fields": "first_name,last_name", "access_token": access_token})
+        if response.status_code == 200:
+            data = response.json()
+            return f"{data.get('first_name', '')} {data.get('last_name', '')}".strip()
+    except httpx.HTTPError as e:
+        logging.error(f"Failed to fetch user name: {e}")
+    return None
+
+# --- Async Message Pipeline ---
+async def process_message(page_id, sender_id, message_text, company_config):
+    """sync process_message-এর async সংস্করণ (একই রাউটিং, থ্রোটলিং এবং ফলব্যাক)"""
+    access_token = company_config['access_token']
+
+    if is_throttled(sender_id):
+        return
+
+    isp_id = extract_isp_user_id(message_text)
+    if isp_id:
+        await save_isp_user_id(page_id, sender_id, isp_id)
+        response_text = ISP_ID_SAVED_MESSAGE.format(isp_id)
+    else:
+        response_text = get_canned_reply(message_text)
+    if response_text:
+        await add_message_to_history(page_id, sender_id, "user", message_text)
+        await add_message_to_history(page_id, sender_id, "assistant", response_text)
+        await send_message_with_quick_replies(sender_id, response_text, access_token)
+        return
+
+    try:
+        # টাইপিং ইন্ডিকেটর এবং প্রোফাইল লোড একসাথে
+        _, user_profile = await asyncio.gather(
+            send_action(sender_id, "typing_on", access_token),
+            get_user_profile(page_id, sender_id),
+        )
+        user_name = user_profile.get("user_name")
+        if not user_name:
+            user_name = await get_facebook_user_name(sender_id, access_token)
+            if user_name:
+                await update_user_name(page_id, sender_id, user_name)
+
+        knowledge_base = await get_knowledge_base(page_id, company_config)
+        dynamic_context = knowledge_base_context(message_text, knowledge_base)
+        response_text = await ask_speednet_ai(message_text, user_profile.get("summary", ""), dynamic_context,
+                                              company_config['bot_name'], user_profile.get("isp_user_id"), user_name,
+                                              page_id, company_config)
+
+        await add_message_to_history(page_id, sender_id, "user", message_text)
+        await add_message_to_history(page_id, sender_id, "assistant", response_text)
+        await send_action(sender_id, "typing_off", access_token)
+        await send_message_with_quick_replies(sender_id, response_text, access_token)
+
+        await prune_and_summarize(page_id, sender_id, company_config)
+    except Exception as e:
+        logging.error(f"Error in async process_message AI block: {e}")
+        await send_action(sender_id, "typing_off", access_token)
+        await send_message_with_quick_replies(sender_id, BUSY_FALLBACK_MESSAGE, access_token)
+
+async def handle_incoming_message(recipient_id, sender_id, message_text):
+    try:
+        company_config = await get_company_config(recipient_id)
+    except Exception as e:
+        logging.error(f"Failed to load config for {recipient_id}: {e}")
+        return
+    if not company_config:
+        logging.warning(f"Unknown Page ID: {recipient_id}. Ignoring message.")
+        return
+    if message_text:
+        await process_message(recipient_id, sender_id, message_text, company_config)
+    else:
+        await send_message(sender_id, NON_TEXT_REPLY, company_config['access_token'], NON_TEXT_QUICK_REPLIES)
+
+async def conversation_worker():
+    while True:
+        recipient_id, sender_id, message_text = await incoming_messages.get()
+        try:
+            await handle_incoming_message(recipient_id, sender_id, message_text)
+        except Exception as e:
+            logging.error(f"Failed to handle message from {sender_id}: {e}")
+        finally:
+            incoming_messages.task_done()
+
+# --- Routes ---
+async def verify(request):
+    if request.query_params.get("hub.verify_token") == VERIFY_TOKEN:
+        return PlainTextResponse(request.query_params.get("hub.challenge", ""))
+    return PlainTextResponse("Verification Token Mismatch", status_code=403)
+
+async def webhook(request):
+    data = await request.json()
+    # ফেসবুককে সাথে সাথে 200 দেওয়া হয়; প্রসেসিং কিউ থেকে ওয়ার্কার টাস্কে চলে
+    for recipient_id, sender_id, message_text in iter_incoming_messages(data):
+        try:
+            incoming_messages.put_nowait((recipient_id, sender_id, message_text))
+        except asyncio.QueueFull:
+            # ওভারলোডে মেসেজ বাদ দেওয়া হয় (কোনো DB/Graph কল ছাড়াই), যাতে মেমরি ও ল্যাটেন্সি সীমিত থাকে
+            logging.warning(f"Incoming queue full ({incoming_messages.maxsize}); dropping message from {sender_id} to {recipient_id}")
+    return PlainTextResponse("EVENT_RECEIVED")
+
+@asynccontextmanager
+async def lifespan(_):
+    global http_client, incoming_messages
+    http_client = httpx.AsyncClient(timeout=GRAPH_API_TIMEOUT)
+    incoming_messages = asyncio.Queue(ASYNC_QUEUE_SIZE)
+    conversation_workers.extend(asyncio.create_task(conversation_worker()) for _ in range(ASYNC_MAX_CONVERSATIONS))
+    await db_pool.open(wait=False)
+    yield
+    # কিউতে থাকা মেসেজগুলো শেষ করার সুযোগ দিয়ে ওয়ার্কার বন্ধ
+    try:
+        await asyncio.wait_for(incoming_messages.join(), LLM_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning(f"Shutting down with {incoming_messages.qsize()} queued messages unprocessed")
+    for worker in conversation_workers:
+        worker.cancel()
+    await asyncio.gather(*conversation_workers, return_exceptions=True)
+    # LLM ওয়ার্কার ও ফ্লাশার থামার পরেই শেষ flush, যাতে পুল বন্ধের পরে কেউ ডাটাবেসে লিখতে না যায়
+    await llm_scheduler.stop()
+    await llm_scheduler.flush_degraded()
+    if background_tasks:
+        await asyncio.wait(background_tasks, timeout=LLM_QUEUE_TIMEOUT)
+    await db_pool.close()
+    await http_client.aclose()
+
+app = Starlette(
+    routes=[
+        Route("/webhook", verify, methods=["GET"]),
+        Route("/webhook", webhook, methods=["POST"]),
+        # বাকি সব (ড্যাশবোর্ড, অ্যাডমিন API, হেলথ চেক) sync Flask অ্যাপ থেকে
+        Mount("/", app=WsgiToAsgi(sync_app.app)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,234 @@
+"""
+Sync (gunicorn app:app) এবং async (uvicorn asgi:app) মোডের এন্ড-টু-এন্ড ওয়েবহুক বেঞ্চমার্ক।
+
+বেঞ্চমার্ক নিজেই একটি লোকাল মক সার্ভার চালায় যা Groq এবং Facebook Graph API-র ভূমিকা নেয়
+(--llm-delay দিয়ে LLM-এর ল্যাটেন্সি সিমুলেট করা যায়)। প্রতিটি মেসেজ পুরো পাইপলাইন পার হয়ে
+ইউজারকে উত্তর পাঠালে (মক Graph-এ /me/messages পৌঁছালে) সেটি "সম্পন্ন" গণনা হয়, তাই দুই মোড একই কাজ মাপে।
+
+    python bench.py --seed                                      # টেস্ট পেজগুলো ডাটাবেসে তৈরি (একবার)
+    export GROQ_BASE_URL=http://127.0.0.1:9100 GROQ_API_KEY=bench GRAPH_API_URL=http://127.0.0.1:9100
+    export TENANT_MAX_PENDING=1000
+    gunicorn -w 4 -b 127.0.0.1:5001 app:app
+    uvicorn asgi:app --port 5002
+    python bench.py --url http://127.0.0.1:5001/webhook --pid <gunicorn master pid>
+    python bench.py --url http://127.0.0.1:5002/webhook --pid <uvicorn pid>
+
+সার্ভার এবং বেঞ্চমার্ক একই DATABASE_URL ব্যবহার করবে।
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import threading
+import time
+
+import httpx
+
+BENCH_PAGE_PREFIX = "bench-page-"
+
+
+def webhook_payload(page_id, sender_id, text):
+    return {
+        "object": "page",
+        "entry": [{"messaging": [{"sender": {"id": sender_id}, "recipient": {"id": page_id}, "message": {"text": text}}]}],
+    }
+
+
+def process_rss_mb(pid):
+    """প্রসেস এবং তার চাইল্ড প্রসেসগুলোর (gunicorn ওয়ার্কার) মোট RSS, MB-তে (Linux /proc থেকে)"""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    total_kb = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            continue
+    return total_kb / 1024
+
+
+def seed_pages(count):
+    """বাজেট সীমা ছাড়া টেস্ট পেজ তৈরি করে এবং /register-এর মতো নলেজ বেস কম্পাইল করে"""
+    import app
+
+    app.init_db()
+    try:
+        with open("training_data.txt", encoding="utf-8") as f:
+            business_info = f.read()
+    except FileNotFoundError:
+        business_info = "## প্যাকেজ\nবেঞ্চমার্ক টেস্ট পেজ"
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        for i in range(count):
+            page_id = f"{BENCH_PAGE_PREFIX}{i}"
+            cursor.execute('''
+                INSERT INTO companies (page_id, access_token, business_info, bot_name, page_name, rpm_limit, daily_token_budget)
+                VALUES (%s, 'bench-token', %s, 'Bench Bot', %s, 1000000, 2000000000)
+                ON CONFLICT (page_id) DO UPDATE SET business_info = EXCLUDED.business_info,
+                    rpm_limit = EXCLUDED.rpm_limit, daily_token_budget = EXCLUDED.daily_token_budget
+            ''', (page_id, business_info, page_id))
+            app.save_knowledge_base(cursor, page_id, business_info)
+        conn.commit()
+    print(f"Seeded {count} bench pages ({BENCH_PAGE_PREFIX}0..{count - 1})")
+
+
+class MockUpstream:
+    """Groq এবং Graph API-র লোকাল মক; ইউজারকে পাঠানো উত্তরের সময় sender_id অনুযায়ী রেকর্ড করে"""
+
+    def __init__(self, port, llm_delay):
+        self.port = port
+        self.llm_delay = llm_delay
+        self.completed = {}
+        self.llm_calls = 0
+        self.server = None
+
+    def build_app(self):
+        from starlette.applications import Starlette
+        from starlette.responses import JSONResponse
+        from starlette.routing import Route
+
+        async def chat_completion(request):
+            body = await request.json()
+            self.llm_calls += 1
+            await asyncio.sleep(self.llm_delay)
+            return JSONResponse({
+                "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", ""),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "বেঞ্চমার্ক উত্তর"}}],
+                "usage": {"prompt_tokens": 400, "completion_tokens": 50, "total_tokens": 450},
+            })
+
+        async def send_api(request):
+            body = await request.json()
+            recipient_id = body.get("recipient", {}).get("id")
+            if "message" in body:
+                self.completed.setdefault(recipient_id, time.perf_counter())
+            return JSONResponse({"recipient_id": recipient_id, "message_id": "bench"})
+
+        async def user_profile(request):
+            return JSONResponse({"first_name": "Bench", "last_name": "User"})
+
+        return Starlette(routes=[
+            Route("/openai/v1/chat/completions", chat_completion, methods=["POST"]),
+            Route("/{version}/me/messages", send_api, methods=["POST"]),
+            Route("/{version}/{user_id}", user_profile, methods=["GET"]),
+        ])
+
+    def start(self):
+        import uvicorn
+
+        config = uvicorn.Config(self.build_app(), host="127.0.0.1", port=self.port, log_level="warning", backlog=4096)
+        self.server = uvicorn.Server(config)
+        thread = threading.Thread(target=self.server.run, daemon=True)
+        thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+
+
+async def run(args):
+    mock = MockUpstream(args.mock_port, args.llm_delay)
+    mock.start()
+
+    ack_latencies = []
+    sent_at = {}
+    errors = 0
+    peak_rss = 0.0
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+    run_id = f"{os.getpid()}-{int(time.time())}"
+
+    async def client_worker(client):
+        nonlocal errors
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            # আলাদা sender_id, যাতে ইউজারভিত্তিক থ্রোটলিং বেঞ্চমার্কে বাধা না দেয়
+            sender_id = f"bench-{run_id}-{i}"
+            page_id = f"{BENCH_PAGE_PREFIX}{i % args.pages}"
+            started = time.perf_counter()
+            sent_at[sender_id] = started
+            try:
+                response = await client.post(args.url, json=webhook_payload(page_id, sender_id, args.text))
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            ack_latencies.append(time.perf_counter() - started)
+
+    async def rss_sampler():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, process_rss_mb(args.pid))
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.create_task(rss_sampler()) if args.pid else None
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        await asyncio.gather(*(client_worker(client) for _ in range(args.concurrency)))
+
+    # সব উত্তর পৌঁছানো পর্যন্ত (বা --timeout পর্যন্ত) অপেক্ষা
+    deadline = time.perf_counter() + args.timeout
+    while len(mock.completed) < len(sent_at) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    if sampler:
+        sampler.cancel()
+    mock.stop()
+
+    completions = sorted(mock.completed[s] - sent_at[s] for s in sent_at if s in mock.completed)
+    finished_at = max((mock.completed[s] for s in sent_at if s in mock.completed), default=started)
+    ack_latencies.sort()
+
+    def percentile(values, p):
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+    def summary(values):
+        if not values:
+            return "n/a"
+        return (f"mean {statistics.mean(values) * 1000:.1f} | p50 {percentile(values, 0.50):.1f} | "
+                f"p95 {percentile(values, 0.95):.1f} | p99 {percentile(values, 0.99):.1f}")
+
+    print(f"URL:              {args.url}")
+    print(f"Requests:         {len(ack_latencies)} (concurrency {args.concurrency}, {args.pages} pages), HTTP errors: {errors}")
+    print(f"Completed:        {len(completions)} replies, {mock.llm_calls} LLM calls (mock delay {args.llm_delay * 1000:.0f} ms)")
+    print(f"Throughput:       {len(completions) / max(finished_at - started, 1e-9):.1f} replies/s end-to-end")
+    print(f"Webhook ack (ms): {summary(ack_latencies)}")
+    print(f"Reply (ms):       {summary(completions)}")
+    if args.pid:
+        print(f"Server RSS:       peak {peak_rss:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end webhook benchmark for sync vs async serving modes")
+    parser.add_argument("--url", default="http://127.0.0.1:5000/webhook")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=20, help="মেসেজগুলো কতটি টেস্ট পেজে ভাগ হবে")
+    parser.add_argument("--text", default="আমার ইন্টারনেট স্পিড সমস্যা")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--llm-delay", type=float, default=0.5, help="মক Groq-এর প্রতি কলের ল্যাটেন্সি (সেকেন্ড)")
+    parser.add_argument("--pid", type=int, help="সার্ভার প্রসেসের PID (পিক মেমরি মাপার জন্য, শুধু Linux)")
+    parser.add_argument("--seed", action="store_true", help="--pages সংখ্যক টেস্ট পেজ ডাটাবেসে তৈরি করে বের হয়ে যায়")
+    args = parser.parse_args()
+    if args.seed:
+        seed_pages(args.pages)
+        return
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()